@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the integrator of conn2res.reservoir.SpikingNeuralNetwork
+
+Run as
+
+    python benchmarks/bench_snn.py
+
+to print, for networks of increasing size, the time per internal time step
+of the synaptic filter alone when its decay factors are recomputed at every
+step or precomputed once, of storing spike times with np.append or with a
+growable buffer, and of SpikingNeuralNetwork.simulate with dense or sparse
+(event-driven) connectivity and with the numpy or numba backend.
+"""
+import timeit
+
+import numpy as np
+
+from conn2res.reservoir import SpikingNeuralNetwork, _SpikeBuffer
+
+N_NODES = [100, 1000, 5000]
+N_SAMPLES = 20
+TIMESCALE = 100
+
+
+def bench_filter(n_nodes, dt=0.05e-3, tr=2e-3, n_steps=10000):
+    """
+    Time per step of the double-exponential synaptic filter
+    """
+    rng = np.random.default_rng(0)
+    td = rng.uniform(20e-3, 50e-3, size=n_nodes)
+    IPSC, h, r, hr, JD = rng.random((5, n_nodes))
+    spikes = rng.random(n_nodes) < 0.01
+
+    def recomputed():
+        IPSC * np.exp(-dt / td) + h * dt
+        h * np.exp(-dt / tr) + JD / (tr * td)
+        r * np.exp(-dt / td) + hr * dt
+        hr * np.exp(-dt / tr) + spikes / (tr * td)
+
+    decay_td = np.exp(-dt / td)
+    decay_tr = np.exp(-dt / tr)
+    tr_td = tr * td
+
+    def precomputed():
+        IPSC * decay_td + h * dt
+        h * decay_tr + JD / tr_td
+        r * decay_td + hr * dt
+        hr * decay_tr + spikes / tr_td
+
+    return [timeit.timeit(func, number=n_steps) / n_steps
+            for func in (recomputed, precomputed)]
+
+
+def bench_spikes(n_nodes, rate=0.05, n_steps=5000, dt=0.05e-3):
+    """
+    Time per step of storing spike times, with a fraction 'rate' of the
+    neurons spiking at every step
+    """
+    rng = np.random.default_rng(0)
+    index = [np.flatnonzero(rng.random(n_nodes) < rate)
+             for _ in range(n_steps)]
+
+    def appended():
+        tspike = np.zeros((0, 2))
+        for i in range(n_steps):
+            curr_ts = np.column_stack(
+                (index[i], np.zeros(len(index[i])) + dt * i))
+            tspike = np.append(tspike, curr_ts, axis=0)
+
+    def buffered():
+        spikes = _SpikeBuffer()
+        for i in range(n_steps):
+            spikes.append(index[i], i)
+        indices, steps = spikes.finalize()
+        np.column_stack((indices, steps * dt))
+
+    return [timeit.timeit(func, number=1) / n_steps
+            for func in (appended, buffered)]
+
+
+def bench_simulate(n_nodes, sparse=False, density=0.1, backend='numpy'):
+    """
+    Time per internal time step of SpikingNeuralNetwork.simulate
+    """
+    rng = np.random.default_rng(0)
+    w = rng.normal(scale=1 / np.sqrt(density * n_nodes),
+                   size=(n_nodes, n_nodes))
+    w[rng.random((n_nodes, n_nodes)) > density] = 0
+    w_in = rng.normal(size=(1, n_nodes))
+    ext_input = rng.uniform(-1, 1, size=(N_SAMPLES, 1))
+
+    snn = SpikingNeuralNetwork(w=w, sparse=sparse, backend=backend)
+    if backend == 'numba':
+        # exclude the compilation time
+        snn.simulate(ext_input[:1], w_in, timescale=1, record=None)
+    elapsed = timeit.timeit(
+        lambda: snn.simulate(ext_input, w_in, timescale=TIMESCALE,
+                             record=None),
+        number=1)
+
+    return elapsed / (N_SAMPLES * TIMESCALE)
+
+
+if __name__ == '__main__':
+    print(f"{'N':>6} {'filter (recomputed)':>20} {'filter (precomputed)':>21}"
+          f" {'spikes (append)':>16} {'spikes (buffer)':>16}"
+          f" {'simulate (dense)':>17} {'simulate (sparse)':>18}"
+          f" {'numba (dense)':>14} {'numba (sparse)':>15}  [us/step]")
+    for n_nodes in N_NODES:
+        recomputed, precomputed = bench_filter(n_nodes)
+        appended, buffered = bench_spikes(n_nodes)
+        dense = bench_simulate(n_nodes)
+        sparse = bench_simulate(n_nodes, sparse=True)
+        numba_dense = bench_simulate(n_nodes, backend='numba')
+        numba_sparse = bench_simulate(n_nodes, sparse=True, backend='numba')
+        print(f"{n_nodes:>6} {1e6 * recomputed:>20.2f} "
+              f"{1e6 * precomputed:>21.2f} {1e6 * appended:>16.2f} "
+              f"{1e6 * buffered:>16.2f} {1e6 * dense:>17.2f} "
+              f"{1e6 * sparse:>18.2f} {1e6 * numba_dense:>14.2f} "
+              f"{1e6 * numba_sparse:>15.2f}")
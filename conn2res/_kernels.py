@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled (numba) kernels for simulating reservoirs
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def check_numba():
+    """
+    Raises an ImportError if numba is not installed
+    """
+    if numba is None:
+        raise ImportError("backend='numba' requires numba to be installed, "
+                          "e.g., pip install conn2res[numba]")
+
+
+# activation functions of EchoStateNetwork in scalar form; p holds the
+# keyword arguments of the corresponding numpy activation function in the
+# order of their signature (see EchoStateNetwork.set_activation_function)
+def _linear(x, p):
+    return p[0] * x
+
+
+def _elu(x, p):
+    if x <= 0:
+        return p[0] * (np.exp(x) - 1)
+    return x
+
+
+def _relu(x, p):
+    return max(0.0, x)
+
+
+def _leaky_relu(x, p):
+    return max(p[0] * x, x)
+
+
+def _sigmoid(x, p):
+    return 1.0 / (1 + np.exp(-x))
+
+
+def _tanh(x, p):
+    return np.tanh(x)
+
+
+def _step(x, p):
+    # the numpy implementation casts the output to int
+    if x < p[0]:
+        return float(int(p[1]))
+    return float(int(p[2]))
+
+
+ESN_ACTIVATIONS = {
+    'linear': _linear,
+    'elu': _elu,
+    'relu': _relu,
+    'leaky_relu': _leaky_relu,
+    'sigmoid': _sigmoid,
+    'tanh': _tanh,
+    'step': _step,
+}
+
+# compiled time loops of EchoStateNetwork, one per activation function and
+# storage format of w
+_esn_kernels = {}
+
+
+def _make_esn_dense(activation):
+
+    @numba.njit(cache=False)
+    def kernel(x, w, alphas, drive, rec_idx, nodes, out, p):
+        # x: (B, N) current states (updated in place)
+        # w: (N, N) connectivity matrix
+        # alphas: (B,) spectral scalings
+        # drive: (K, S, N) input drive of S sequences; row b of x is
+        #   driven by sequence b % S
+        # rec_idx: (K,) index in out of each time step (-1: not recorded)
+        # nodes: (N_rec,) recorded nodes
+        # out: (B, time, N_rec) recorded states
+        n_batch, n_nodes = x.shape
+        n_seq = drive.shape[1]
+        for t in range(drive.shape[0]):
+            synap_input = np.dot(x, w)
+            for b in range(n_batch):
+                for j in range(n_nodes):
+                    x[b, j] = activation(
+                        alphas[b] * synap_input[b, j]
+                        + drive[t, b % n_seq, j], p)
+                if rec_idx[t] >= 0:
+                    for k in range(nodes.shape[0]):
+                        out[b, rec_idx[t], k] = x[b, nodes[k]]
+
+    return kernel
+
+
+def _make_esn_sparse(activation):
+
+    @numba.njit(cache=False)
+    def kernel(x, data, indices, indptr, alphas, drive, rec_idx, nodes, out,
+               p):
+        # same as the dense kernel with w given in CSC format
+        n_batch, n_nodes = x.shape
+        n_seq = drive.shape[1]
+        synap_input = np.empty(n_nodes)
+        for t in range(drive.shape[0]):
+            for b in range(n_batch):
+                for j in range(n_nodes):
+                    acc = 0.0
+                    for k in range(indptr[j], indptr[j + 1]):
+                        acc += data[k] * x[b, indices[k]]
+                    synap_input[j] = acc
+                for j in range(n_nodes):
+                    x[b, j] = activation(
+                        alphas[b] * synap_input[j] + drive[t, b % n_seq, j],
+                        p)
+                if rec_idx[t] >= 0:
+                    for k in range(nodes.shape[0]):
+                        out[b, rec_idx[t], k] = x[b, nodes[k]]
+
+    return kernel
+
+
+def get_esn_kernel(activation, sparse=False):
+    """
+    Returns the compiled time loop of an EchoStateNetwork for a built-in
+    activation function
+
+    Parameters
+    ----------
+    activation : str
+        name of the activation function (see ESN_ACTIVATIONS)
+    sparse : bool, optional
+        whether the connectivity matrix is in CSC format, by default False
+
+    Returns
+    -------
+    kernel : numba.core.registry.CPUDispatcher
+        compiled time loop
+
+    Raises
+    ------
+    ValueError
+        if the activation function is not built in
+    """
+    check_numba()
+
+    if activation not in ESN_ACTIVATIONS:
+        raise ValueError(f"backend='numba' does not support activation "
+                         f"function '{activation}'")
+
+    key = (activation, sparse)
+    if key not in _esn_kernels:
+        func = numba.njit(ESN_ACTIVATIONS[activation])
+        if sparse:
+            _esn_kernels[key] = _make_esn_sparse(func)
+        else:
+            _esn_kernels[key] = _make_esn_dense(func)
+
+    return _esn_kernels[key]
+
+
+# compiled time loops of SpikingNeuralNetwork, one per storage format of w
+_lif_kernels = {}
+
+
+def _make_lif_kernel(sparse):
+
+    if sparse:
+        @numba.njit(cache=False)
+        def propagate(JD, j, data, indices, indptr):
+            # outgoing weights of neuron j with w given in CSC format
+            for k in range(indptr[j], indptr[j + 1]):
+                JD[indices[k]] += data[k]
+    else:
+        @numba.njit(cache=False)
+        def propagate(JD, j, w_t, indices, indptr):
+            # outgoing weights of neuron j with w given as its transpose
+            for k in range(w_t.shape[1]):
+                JD[k] += w_t[j, k]
+
+    @numba.njit(cache=False)
+    def kernel(start, v, IPSC, h, r, hr, refractory, w0, w1, w2, ext_stim,
+               noise, stim_mask, stim_ptr, prot_ptr, stim_units, amplitude,
+               rs, spike_counts, REC, Is, IPSCs, hs, dec, timescale, dt,
+               n_ref, tm, bias, vreset, vpeak, decay_td, decay_tr, td, tr_td,
+               tr):
+        # start: index of the first time step of the block
+        # v, IPSC, h, r, hr, refractory: (B, N) state of the neurons of B
+        #   replicas preceding the block of time steps (updated in place);
+        #   refractory counts down the time steps during which the voltage
+        #   is frozen, and is set to n_ref after a spike
+        # w0, w1, w2: connectivity matrix as (data, indices, indptr) in CSC
+        #   format, or as (w.T, _, _)
+        # ext_stim: (B, N, time) external input current
+        # noise: (K, B, N) noise of the membrane voltage ((0, B, N): no
+        #   noise)
+        # stim_mask: (K, P) whether each of P stimulation protocols is
+        #   applied at each time step
+        # stim_ptr: the protocols of replica b are stim_ptr[b]:stim_ptr[b + 1]
+        # prot_ptr, stim_units: protocol p shifts the voltage of the neurons
+        #   stim_units[prot_ptr[p]:prot_ptr[p + 1]] (flat indices b * N + k)
+        #   by amplitude[p]
+        # rs: (B, time, N) filtered firing rates summed over every
+        #   'timescale' time steps (updated in place)
+        # spike_counts: (B, time, N) spike counts of every 'timescale' time
+        #   steps (updated in place)
+        # REC, Is, IPSCs, hs: recordings, kept every dec[k]-th time step
+        #   (dec[k] = 0: not recorded)
+        # decay_td, td, tr_td: (B, N) parameters of the synaptic filter
+        # spikes are returned as flat indices b * N + k and time steps
+        n_batch, n_nodes = v.shape
+        n_steps = stim_mask.shape[0]
+        JD = np.zeros(n_nodes, dtype=v.dtype)
+        spiking = np.empty(n_nodes, dtype=np.int32)
+        spike_idx = np.empty(max(16, n_batch * n_nodes), dtype=np.int32)
+        spike_step = np.empty(max(16, n_batch * n_nodes), dtype=np.int32)
+        n_spikes = 0
+        for t in range(n_steps):
+            i = start + t
+            s = i // timescale
+            for b in range(n_batch):
+                if dec[2] > 0 and i % dec[2] == 0:
+                    for k in range(n_nodes):
+                        IPSCs[b, k, i // dec[2]] = IPSC[b, k]
+                if dec[1] > 0 and i % dec[1] == 0:
+                    for k in range(n_nodes):
+                        Is[b, k, i // dec[1]] = ext_stim[b, k, s]
+
+                # LIF equation (voltage is frozen during the refractory
+                # period)
+                for k in range(n_nodes):
+                    if refractory[b, k] == 0:
+                        I = IPSC[b, k] + bias + ext_stim[b, k, s]
+                        v[b, k] += dt * ((-v[b, k] + I) / tm)
+                    else:
+                        refractory[b, k] -= 1
+                    if noise.shape[0] > 0:
+                        v[b, k] += noise[t, b, k]
+                for p in range(stim_ptr[b], stim_ptr[b + 1]):
+                    if stim_mask[t, p]:
+                        for u in stim_units[prot_ptr[p]:prot_ptr[p + 1]]:
+                            v[b, u - b * n_nodes] += amplitude[p]
+
+                # spiking neurons and their weighted contributions to IPSC
+                n_spk = 0
+                for k in range(n_nodes):
+                    if v[b, k] >= vpeak:
+                        spiking[n_spk] = k
+                        n_spk += 1
+                JD[:] = 0
+                for j in spiking[:n_spk]:
+                    propagate(JD, j, w0, w1, w2)
+
+                # store spike events
+                if n_spikes + n_spk > spike_idx.shape[0]:
+                    size = max(2 * spike_idx.shape[0], n_spikes + n_spk)
+                    new_idx = np.empty(size, dtype=np.int32)
+                    new_step = np.empty(size, dtype=np.int32)
+                    new_idx[:n_spikes] = spike_idx[:n_spikes]
+                    new_step[:n_spikes] = spike_step[:n_spikes]
+                    spike_idx, spike_step = new_idx, new_step
+                for m in range(n_spk):
+                    spike_idx[n_spikes + m] = b * n_nodes + spiking[m]
+                    spike_step[n_spikes + m] = i
+                n_spikes += n_spk
+
+                for k in range(n_nodes):
+                    spike = v[b, k] >= vpeak
+                    if spike:
+                        refractory[b, k] = n_ref
+                        spike_counts[b, s, k] += 1
+
+                    # synaptic filter
+                    if tr == 0:
+                        IPSC[b, k] = IPSC[b, k] * decay_td[b, k] \
+                            + JD[k] / td[b, k]
+                        r[b, k] = r[b, k] * decay_td[b, k] + spike / td[b, k]
+                    else:
+                        IPSC[b, k] = IPSC[b, k] * decay_td[b, k] \
+                            + h[b, k] * dt
+                        h[b, k] = h[b, k] * decay_tr + JD[k] / tr_td[b, k]
+                        r[b, k] = r[b, k] * decay_td[b, k] + hr[b, k] * dt
+                        hr[b, k] = hr[b, k] * decay_tr + spike / tr_td[b, k]
+                    rs[b, s, k] += r[b, k]
+                    if dec[3] > 0 and i % dec[3] == 0:
+                        hs[b, k, i // dec[3]] = h[b, k]
+
+                    # cap depolarization, record and reset voltage
+                    if spike:
+                        v[b, k] = 30
+                    if dec[0] > 0 and i % dec[0] == 0:
+                        REC[b, i // dec[0], k] = v[b, k]
+                    if spike:
+                        v[b, k] = vreset
+
+        return spike_idx[:n_spikes], spike_step[:n_spikes]
+
+    return kernel
+
+
+def get_lif_kernel(sparse=False):
+    """
+    Returns the compiled time loop of a SpikingNeuralNetwork
+
+    Parameters
+    ----------
+    sparse : bool, optional
+        whether the connectivity matrix is in CSC format, by default False
+
+    Returns
+    -------
+    kernel : numba.core.registry.CPUDispatcher
+        compiled time loop
+    """
+    check_numba()
+
+    if sparse not in _lif_kernels:
+        _lif_kernels[sparse] = _make_lif_kernel(sparse)
+
+    return _lif_kernels[sparse]
@@ -13,6 +13,7 @@ from cycler import cycler
 
 from conn2res import utils
 from .readout import _check_xy_type, _check_x_dims, _check_y_dims
+from .reservoir import SpikeRaster
 
 PROJ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 FIG_DIR = os.path.join(PROJ_DIR, 'figs')
@@ -763,8 +764,10 @@ def plot_spike_raster(tspike, x1, x2, title = "Spike Raster"):
 
     Parameters
     ----------
-    tspike : (N_spikes, 2) numpy.ndarray
-        spike times (in s)
+    tspike : (N_spikes, 2) numpy.ndarray or SpikeRaster
+        spike times (in s), or spike raster (see
+        conn2res.reservoir.SpikeRaster), e.g.,
+        SpikingNeuralNetwork.spikes
         N_spikes: number of spikes
         tspike[:, 0]: spike neuronal indices
         tspike[:, 1]: spike times (in s)
@@ -776,21 +779,22 @@ def plot_spike_raster(tspike, x1, x2, title = "Spike Raster"):
         title of the plot, by default "Spike Raster"
     """
 
-    nneurons = int(np.max(np.unique(tspike[:, 0])) + 1)
+    if isinstance(tspike, SpikeRaster):
+        # only the spikes within the plotted time window are extracted
+        nneurons = tspike.n_nodes
+        neurons, steps = tspike.events(max(int(np.floor(x1 / tspike.dt)), 0),
+                                       int(np.ceil(x2 / tspike.dt)) + 1)
+        times = steps * tspike.dt
+    else:
+        nneurons = int(np.max(np.unique(tspike[:, 0])) + 1)
+        neurons, times = tspike[:, 0], tspike[:, 1]
 
     plt.figure(figsize=(max((x2 - x1)/0.1*10, 10), max(.02*nneurons, 1)))
     plt.title(title)
     plt.xlabel("Time (ms)")
     plt.ylabel("Neuron")
 
-    spike_times = []
-    for neuron in range(nneurons):
-        idx = np.where(tspike[:, 0] == neuron)[0]
-        spike_times.append(tspike[:, 1][idx]*1000)
-    
-    for neuron in range(nneurons):
-        spike_train = spike_times[neuron]
-        plt.scatter(spike_train, [neuron] * len(spike_train), marker='|', color='black')
+    plt.scatter(times * 1000, neurons, marker='|', color='black')
 
     plt.xlim(x1*1000, x2*1000)
     plt.ylim(-0.5, nneurons - 0.5)
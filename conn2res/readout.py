@@ -499,7 +499,9 @@ def _check_xy_type(X, y):
 
 def _check_x_dims(X):
     """
-    Check that X have the right dimensions
+    Check that X have the right dimensions and double precision (reservoir
+    states might be simulated in single precision, but the readout is
+    always solved in double precision)
 
     Parameters
     ----------
@@ -511,6 +513,7 @@ def _check_x_dims(X):
     _type_
         _description_
     """
+    X = np.asarray(X, dtype=np.float64)
 
     if X.ndim == 1:
         return X[:, np.newaxis]
@@ -3,9 +3,62 @@
 Functionality for simulating reservoirs
 """
 from abc import ABCMeta, abstractmethod
+import hashlib
+import inspect
+import json
+import os
 import numpy as np
 from numpy.linalg import pinv
+from scipy import fft as sp_fft
+from scipy import linalg as sp_linalg
+from scipy import sparse as sp
+from scipy.sparse import linalg as sp_sparse_linalg
+from scipy.signal import fftconvolve
 from . import utils
+from . import _kernels
+
+
+# maximum density and minimum number of nodes for which EchoStateNetwork
+# stores the connectivity matrix as a sparse matrix when sparse='auto'
+SPARSE_DENSITY = 0.1
+SPARSE_MIN_NODES = 1000
+
+# number of time steps for which the input drive of EchoStateNetwork is
+# projected at once when it is not precomputed
+DRIVE_BLOCK_SIZE = 1024
+
+# recordings of SpikingNeuralNetwork.simulate (see its 'record' argument)
+SNN_RECORDINGS = ('REC', 'Is', 'IPSCs', 'hs')
+
+# keyword arguments of SpikingNeuralNetwork.simulate that may differ between
+# the replicas of SpikingNeuralNetwork.simulate_batch
+SNN_REPLICA_PARAMS = ('taus', 'tau_min', 'tau_max', 'sig_param',
+                      'input_gain', 'ic', 'stim_mode', 'stim_dur',
+                      'stim_units', 'stim_val', 'stim')
+
+# number of random numbers (time steps x nodes) that SpikingNeuralNetwork
+# draws at once for the noise of the membrane voltage
+NOISE_BLOCK_SIZE = 2 ** 18
+
+
+def _use_sparse(w, sparse):
+    """
+    Returns whether the connectivity matrix w is stored in sparse format
+    given the 'sparse' argument (True, False or 'auto') of a reservoir.
+    Connectivity matrices that are already sparse are always kept sparse.
+    """
+    if sp.issparse(w):
+        return True
+    if sparse == 'auto':
+        # small networks are kept dense (this also avoids computing the
+        # density of a single node)
+        n_nodes = w.shape[0]
+        if n_nodes < SPARSE_MIN_NODES:
+            return False
+        density = np.count_nonzero(w) / (n_nodes * (n_nodes - 1))
+        return density <= SPARSE_DENSITY
+
+    return bool(sparse)
 
 
 class Reservoir(metaclass=ABCMeta):
@@ -46,7 +99,7 @@ class Reservoir(metaclass=ABCMeta):
         """
         self.w = w
         self._state = None
-        self.n_nodes = len(self.w)
+        self.n_nodes = self.w.shape[0]
 
     @abstractmethod
     def simulate(self, *args, **kwargs):
@@ -84,7 +137,7 @@ class EchoStateNetwork(Reservoir):
 
     Attributes
     ----------
-    w : numpy.ndarray
+    w : numpy.ndarray or scipy.sparse.csc_matrix
         reservoir connectivity matrix (source, target)
     _state : numpy.ndarray
         reservoir activation states
@@ -92,6 +145,14 @@ class EchoStateNetwork(Reservoir):
         dimension of the reservoir
     activation_function : {'tanh', 'piecewise'}
         type of activation function
+    sparse : bool or 'auto'
+        whether the connectivity matrix is stored as a sparse matrix
+    backend : {'numpy', 'numba'}
+        implementation of the time loop
+    dtype : numpy.dtype
+        floating point precision of the simulation
+    last_state : numpy.ndarray
+        reservoir states at the last simulated time step
 
     Methods
     -------
@@ -99,34 +160,147 @@ class EchoStateNetwork(Reservoir):
 
     simulate
 
+    stream
+
     set_activation_function
 
     """
 
-    def __init__(self, *args, activation_function='tanh', **kwargs):
+    def __init__(self, *args, activation_function='tanh', sparse=False,
+                 backend='numpy', dtype=np.float64, **kwargs):
         """
         Constructor class for Echo State Networks
 
         Parameters
         ----------
-        w: (N, N) numpy.ndarray
+        w: (N, N) numpy.ndarray or scipy.sparse matrix
             Reservoir connectivity matrix (source, target)
             N: number of nodes in the network. If w is directed, then rows
             (columns) should correspond to source (target) nodes.
         activation_function: str {'linear', 'elu', 'relu', 'leaky_relu',
-            'sigmoid', 'tanh', 'step'}, default 'tanh'
-            Activation function (nonlinearity of the system's units)
+            'sigmoid', 'tanh', 'step'} or callable, default 'tanh'
+            Activation function (nonlinearity of the system's units). See
+            self.set_activation_function for user-supplied callables.
+        sparse: bool or 'auto', default False
+            If True, the connectivity matrix is stored in CSC format and
+            the recurrence is computed as a sparse matrix product. If
+            'auto', the sparse format is used whenever the density of w
+            (defined as in conn2res.connectivity.Conn.density) is at most
+            SPARSE_DENSITY and w has at least SPARSE_MIN_NODES nodes.
+            Connectivity matrices that are already sparse are always kept
+            sparse. Note that the format is chosen again every time w is
+            set (e.g., esn.w = alpha * conn.w).
+        backend: {'numpy', 'numba'}, default 'numpy'
+            Implementation of the time loop. If 'numba', the whole time loop
+            is JIT-compiled (requires numba), which removes the interpreter
+            overhead that dominates the simulation of small networks. Only
+            the built-in activation functions are supported. The first
+            simulation includes the compilation time.
+        dtype: numpy.dtype, default numpy.float64
+            Floating point precision in which the connectivity matrix is
+            stored and the dynamics are simulated. numpy.float32 halves the
+            memory of the simulated states and roughly doubles BLAS
+            throughput. On the MemoryCapacity task the memory capacity
+            obtained with numpy.float32 deviates less than 0.1% from that
+            obtained with numpy.float64 (see
+            conn2res/tests/test_reservoir.py). Note that the readout is
+            always solved in double precision.
         """
 
+        self.sparse = sparse
+        self.dtype = np.dtype(dtype)
+        self._last_state = None
+
+        if backend not in ('numpy', 'numba'):
+            raise ValueError("backend must be either 'numpy' or 'numba'")
+        if backend == 'numba':
+            _kernels.check_numba()
+        self.backend = backend
+
         super().__init__(*args, **kwargs)
 
         # activation function
+        if backend == 'numba' and callable(activation_function):
+            raise ValueError("backend='numba' only supports the built-in "
+                             "activation functions")
         self.activation_function = self.set_activation_function(
             activation_function)
 
+    @property
+    def w(self):
+        return self._w
+
+    @w.setter
+    def w(self, w):
+        """
+        Set the reservoir connectivity matrix either as a dense or a sparse
+        (CSC) matrix depending on self.sparse
+
+        Parameters
+        ----------
+        w : (N, N) numpy.ndarray or scipy.sparse matrix
+            reservoir connectivity matrix (source, target)
+        """
+        # CSC format makes the product state @ w (i.e., w.T @ state.T)
+        # a row-wise sparse product
+        if _use_sparse(w, self.sparse):
+            self._w = sp.csc_matrix(w, dtype=self.dtype)
+        else:
+            self._w = np.asarray(w, dtype=self.dtype)
+
+    @property
+    def last_state(self):
+        """
+        Reservoir states at the last time step of the most recent call to
+        simulate() or stream(). Passing them as initial conditions 'ic'
+        continues the simulation seamlessly, e.g., to simulate the train
+        and test sets as one continuous run.
+
+        Returns
+        -------
+        last_state : (N,) or (N_alpha, N) numpy.ndarray
+            N: number of nodes in the network
+            N_alpha: number of spectral scalings in 'alphas'
+        """
+        return self._last_state
+
+    def input_drive(self, ext_input, w_in):
+        """
+        Computes the input drive of the reservoir, i.e., the projection
+        ext_input @ w_in, for all time steps at once. The result can be
+        passed to simulate() via 'drive' and reused across repeated
+        simulations that share the same ext_input and w_in (e.g., when
+        sweeping over alpha)
+
+        Parameters
+        ----------
+        ext_input : (time, N_inputs) numpy.ndarray or list of them
+            External input signal
+            N_inputs: number of external input signals
+        w_in : (N_inputs, N) numpy.ndarray
+            Input connectivity matrix (source, target)
+            N_inputs: number of external input signals
+            N: number of nodes in the network
+
+        Returns
+        -------
+        drive : (time, N) numpy.ndarray or list of them
+            Input drive of the reservoir (same type as ext_input) in the
+            precision of the reservoir (i.e., self.dtype)
+        """
+        if isinstance(ext_input, (list, tuple)):
+            return [self.input_drive(x, w_in) for x in ext_input]
+
+        ext_input = np.asarray(ext_input)
+        if ext_input.ndim == 1:
+            ext_input = ext_input[:, np.newaxis]
+
+        return (ext_input @ w_in).astype(self.dtype, copy=False)
+
     def simulate(
-        self, ext_input, w_in, ic=None, output_nodes=None,
-        return_states=True, **kwargs
+        self, ext_input=None, w_in=None, ic=None, output_nodes=None,
+        return_states=True, alphas=None, drive=None, save_state=True,
+        idx_washout=0, independent_trials=False, **kwargs
     ):
         """
         Simulates reservoir dynamics given an external input signal
@@ -135,113 +309,1429 @@ class EchoStateNetwork(Reservoir):
         Parameters
         ----------
         ext_input : (time, N_inputs) numpy.ndarray
-            External input signal
+            External input signal. Not needed if 'drive' is provided.
             N_inputs: number of external input signals
         w_in : (N_inputs, N) numpy.ndarray
-            Input connectivity matrix (source, target)
+            Input connectivity matrix (source, target). Not needed if
+            'drive' is provided.
             N_inputs: number of external input signals
             N: number of nodes in the network
-        ic : (N,) numpy.ndarray, optional
+        ic : (N,) or (N_alpha, N) numpy.ndarray, optional
             Initial conditions
             N: number of nodes in the network. If w is directed, then rows
             (columns) should correspond to source (target) nodes.
+            N_alpha: number of spectral scalings in 'alphas'
         output_nodes : list or numpy.ndarray, optional
             List of nodes for which reservoir states will be returned if
             'return_states' is True.
         return_states : bool, optional
             If True, simulated resrvoir states are returned. True by default.
+        alphas : float or (N_alpha,) array_like, optional
+            Spectral scaling(s) applied to the reservoir connectivity matrix,
+            i.e., the dynamics are simulated with alpha * w for each alpha
+            in 'alphas' (note that 'alpha' itself is reserved for keyword
+            arguments of the activation function). If array_like,
+            all N_alpha reservoirs are simulated together by propagating a
+            (N_alpha, N) block of states, such that each time step requires
+            a single matrix-matrix product. By default None, i.e., w is used
+            as is.
+        drive : (time, N) numpy.ndarray or list of them, optional
+            Precomputed input drive as returned by self.input_drive(). If
+            provided, ext_input and w_in are ignored. Otherwise the drive is
+            projected in blocks of DRIVE_BLOCK_SIZE time steps, such that
+            only the recurrent part is computed step by step.
+        save_state : bool, optional
+            If True, the states of all nodes are stored in self._state.
+            If False, self._state is set to None and only the states of
+            'output_nodes' are recorded while simulating, i.e., memory is
+            only allocated for the current states of all nodes and the
+            (time, N_output_nodes) returned states. True by default.
+        idx_washout : int, optional
+            Number of initial time steps (washout) for which the dynamics
+            are simulated but the states are neither stored nor returned,
+            i.e., the same as applying self.add_washout_time() to the
+            states afterwards but without allocating and copying them. If
+            ext_input is list or tuple, the washout is applied to every
+            trial. By default 0.
+        independent_trials : bool, optional
+            Only used if ext_input is list or tuple. If False, trials are
+            concatenated and simulated as one continuous time series. If
+            True, trials are treated as independent sequences that all
+            start from 'ic': they are padded into a (time, N_trials,
+            N_inputs) batch and advanced in lockstep, such that each time
+            step requires a single matrix-matrix product for all trials.
+            In this case self.last_state is None. By default False.
         kwargs:
             Other keyword arguments are passed to self.activation_function
 
         Returns
         -------
-        self._state : (time, N) numpy.ndarray
-            Activation states of the reservoir.
-            N: number of nodes in the network if output_nodes is None, else
-            number of output_nodes
+        self._state : (time, N) or (N_alpha, time, N) numpy.ndarray
+            Activation states of the reservoir. If 'alphas' is array_like,
+            states are stacked along the first axis (one entry per alpha).
+            N: number of nodes in the network if output_nodes is None, else
+            number of output_nodes
+            If ext_input is list or tuple, a list of arrays is returned
+            instead (a list of lists if 'alphas' is array_like)
+            time: number of time steps after washout
+        """
+        # print('\n GENERATING RESERVOIR STATES ...')
+
+        # a precomputed drive replaces the input signal and needs no further
+        # projection (i.e., w_in is None)
+        if drive is not None:
+            ext_input, w_in = drive, None
+        elif ext_input is None or w_in is None:
+            raise ValueError('either ext_input and w_in, or drive, must be '
+                             'provided')
+
+        # if ext_input is list or tuple convert to numpy.ndarray
+        convert_to_list = isinstance(ext_input, (list, tuple))
+        if convert_to_list:
+            trial_lens = np.array([len(trial) for trial in ext_input])
+        independent_trials = independent_trials and convert_to_list
+
+        # input is simulated as a (time, N_sequences, N_inputs) batch of
+        # sequences, i.e., either the padded independent trials or a
+        # single time series
+        if independent_trials:
+            trials = [np.reshape(trial, (len(trial), -1))
+                      for trial in ext_input]
+            ext_input = np.zeros(
+                (trial_lens.max(), len(trials), trials[0].shape[1]),
+                dtype=np.result_type(*trials))
+            for i, trial in enumerate(trials):
+                ext_input[:len(trial), i] = trial
+        else:
+            if convert_to_list:
+                sections = utils.get_sections(ext_input)
+                ext_input = utils.concat(ext_input)
+            ext_input = np.reshape(ext_input, (len(ext_input), 1, -1))
+        n_timesteps, n_seq, _ = ext_input.shape
+
+        # spectral scaling(s) of the connectivity matrix as a column vector
+        # so that it broadcasts across the block of states
+        batch_alpha = alphas is not None and np.ndim(alphas) > 0
+        if alphas is None:
+            alphas = 1.0
+        alphas = np.atleast_1d(
+            np.asarray(alphas, dtype=self.dtype))[:, np.newaxis, np.newaxis]
+
+        # nodes whose states are recorded: all nodes if states are stored
+        # in self._state, otherwise only the requested output nodes
+        if save_state or output_nodes is None:
+            rec_nodes = None
+            n_rec = self.n_nodes
+        else:
+            rec_nodes = np.arange(self.n_nodes)[output_nodes]
+            n_rec = len(rec_nodes)
+
+        # index at which the states of each time step are recorded, or -1
+        # during the washout of each trial
+        if convert_to_list and not independent_trials:
+            keep = np.concatenate(
+                [np.arange(n) >= idx_washout for n in trial_lens])
+            sections = np.cumsum(np.maximum(
+                trial_lens - idx_washout, 0))[:-1]
+        else:
+            keep = np.arange(n_timesteps) >= idx_washout
+        rec_idx = np.where(keep, np.cumsum(keep) - 1, -1)
+
+        # initialize current reservoir states and recorded states
+        x = np.zeros((len(alphas), n_seq, self.n_nodes), dtype=self.dtype)
+        states = np.zeros((len(alphas), n_seq, np.sum(keep), n_rec),
+                          dtype=self.dtype)
+
+        # set initial conditions
+        if ic is not None:
+            ic = np.asarray(ic)
+            x[:] = ic[:, np.newaxis] if ic.ndim == 2 else ic
+
+        # simulate dynamics
+        x = self._run(x, alphas, ext_input, w_in, states, rec_idx, rec_nodes,
+                      **kwargs)
+
+        # keep states of the last time step to be able to resume (not
+        # defined for independent trials)
+        if independent_trials:
+            self._last_state = None
+        else:
+            self._last_state = x[:, 0].copy() if batch_alpha \
+                else x[0, 0].copy()
+
+        # convert back to list or tuple
+        if independent_trials:
+            rec_lens = np.maximum(trial_lens - idx_washout, 0)
+            states = [[state[i, :n] for i, n in enumerate(rec_lens)]
+                      for state in states]
+            if not batch_alpha:
+                states = states[0]
+        else:
+            states = states[:, 0]
+            if not batch_alpha:
+                states = states[0]
+            if convert_to_list:
+                if batch_alpha:
+                    states = [utils.split(state, sections)
+                              for state in states]
+                else:
+                    states = utils.split(states, sections)
+
+        # output nodes were already selected while recording
+        if not save_state:
+            self._state = None
+            if return_states:
+                return states
+            return
+
+        self._state = states
+
+        # return the same type
+        if return_states:
+            if output_nodes is not None:
+                if convert_to_list and batch_alpha:
+                    return [[state[:, output_nodes] for state in states]
+                            for states in self._state]
+                elif convert_to_list:
+                    return [state[:, output_nodes] for state in self._state]
+                else:
+                    return self._state[..., output_nodes]
+            else:
+                return self._state
+
+    def _run(self, x, alphas, ext_input, w_in, states, rec_idx,
+             rec_nodes=None, **kwargs):
+        """
+        Advances the reservoir states through all time steps and records
+        them
+
+        Parameters
+        ----------
+        x : (N_alpha, S, N) numpy.ndarray
+            initial states
+            N_alpha: number of spectral scalings
+            S: number of simulated sequences (i.e., independent trials)
+        alphas : (N_alpha, 1, 1) numpy.ndarray
+            spectral scalings of the connectivity matrix
+        ext_input : (time, S, N_inputs) numpy.ndarray
+            external input signal, or input drive (time, S, N) if w_in is
+            None
+        w_in : (N_inputs, N) numpy.ndarray or None
+            input connectivity matrix
+        states : (N_alpha, S, time, N_rec) numpy.ndarray
+            array in which the states are recorded
+        rec_idx : (time,) numpy.ndarray
+            index along the time axis of 'states' at which the states of
+            each time step are recorded (-1 if not recorded)
+        rec_nodes : (N_rec,) numpy.ndarray, optional
+            nodes whose states are recorded, by default all nodes
+        kwargs :
+            keyword arguments of self.activation_function
+
+        Returns
+        -------
+        x : (N_alpha, S, N) numpy.ndarray
+            states of the last time step
+        """
+        n_timesteps, n_seq, _ = ext_input.shape
+
+        # synaptic input is computed in a preallocated array, and the
+        # activation function writes the new states into x, such that no
+        # arrays are allocated at each time step (except for sparse w)
+        synap_input = np.empty_like(x)
+
+        # a block of drive holds at most DRIVE_BLOCK_SIZE time steps of all
+        # sequences
+        block_size = max(1, DRIVE_BLOCK_SIZE // n_seq)
+        for start in range(0, n_timesteps, block_size):
+            stop = min(start + block_size, n_timesteps)
+
+            # input drive of the current block of time steps
+            if w_in is None:
+                drive_block = ext_input[start:stop]
+            else:
+                drive_block = ext_input[start:stop] @ w_in
+            drive_block = drive_block.astype(self.dtype, copy=False)
+
+            if self.backend == 'numba':
+                self._simulate_numba(x, alphas, drive_block, states,
+                                     rec_idx[start:stop], rec_nodes,
+                                     **kwargs)
+                continue
+
+            for t in range(start, stop):
+                self._recurrent_input(x, out=synap_input)
+                synap_input *= alphas
+                synap_input += drive_block[t-start]
+                self.activation_function(synap_input, out=x, **kwargs)
+                if rec_idx[t] < 0:
+                    continue
+                if rec_nodes is None:
+                    states[:, :, rec_idx[t]] = x
+                else:
+                    np.take(x, rec_nodes, axis=-1,
+                            out=states[:, :, rec_idx[t]], mode='clip')
+
+        return x
+
+    def _recurrent_input(self, x, out=None):
+        """
+        Computes the recurrent input x @ w for a block of states
+
+        Parameters
+        ----------
+        x : (..., N) numpy.ndarray
+            reservoir states
+        out : (..., N) numpy.ndarray, optional
+            C-contiguous array in which the recurrent input is stored
+
+        Returns
+        -------
+        synap_input : (..., N) numpy.ndarray
+            recurrent input (same shape as x)
+        """
+        if out is None:
+            out = np.empty(x.shape, dtype=np.result_type(x, self.w))
+        if sp.issparse(self.w):
+            out[...] = (x.reshape(-1, self.n_nodes) @ self.w).reshape(
+                x.shape)
+        else:
+            np.matmul(x.reshape(-1, self.n_nodes), self.w,
+                      out=out.reshape(-1, self.n_nodes))
+        return out
+
+    def stream(self, chunks, w_in=None, ic=None, idx_washout=0, **kwargs):
+        """
+        Simulates reservoir dynamics block by block for an external input
+        signal that is provided in chunks, e.g., read from disc or
+        generated on the fly. The simulation continues seamlessly from one
+        chunk to the next, so that memory is bounded by the size of the
+        chunks. After the last chunk, self.last_state can be used to
+        resume the simulation.
+
+        Parameters
+        ----------
+        chunks : iterable of (time, N_inputs) numpy.ndarray
+            Consecutive chunks of the external input signal, or of the
+            precomputed input drive (time, N) if w_in is None
+        w_in : (N_inputs, N) numpy.ndarray, optional
+            Input connectivity matrix (source, target). If None, chunks are
+            treated as input drive (see self.input_drive())
+        ic : (N,) or (N_alpha, N) numpy.ndarray, optional
+            Initial conditions of the first chunk, e.g., self.last_state
+        idx_washout : int, optional
+            Number of initial time steps of the whole signal (i.e., possibly
+            spanning several chunks) for which states are not returned.
+            By default 0.
+        kwargs:
+            Other keyword arguments are passed to self.simulate (e.g.,
+            output_nodes or alphas)
+
+        Yields
+        ------
+        states : (time, N) or (N_alpha, time, N) numpy.ndarray
+            Activation states of the reservoir for each chunk (see
+            self.simulate)
+        """
+        for chunk in chunks:
+            washout = min(idx_washout, len(chunk))
+            idx_washout -= washout
+
+            if w_in is None:
+                states = self.simulate(drive=chunk, ic=ic, save_state=False,
+                                       idx_washout=washout, **kwargs)
+            else:
+                states = self.simulate(chunk, w_in, ic=ic, save_state=False,
+                                       idx_washout=washout, **kwargs)
+            ic = self._last_state
+
+            yield states
+
+    def _simulate_numba(self, x, alphas, drive, out, rec_idx, rec_nodes=None,
+                        **kwargs):
+        """
+        Runs the compiled time loop for a block of time steps
+
+        Parameters
+        ----------
+        x : (N_alpha, S, N) numpy.ndarray
+            states preceding the block of time steps (updated in place)
+            N_alpha: number of spectral scalings
+            S: number of simulated sequences (i.e., independent trials)
+        alphas : (N_alpha, 1, 1) numpy.ndarray
+            spectral scalings of the connectivity matrix
+        drive : (K, S, N) numpy.ndarray
+            input drive of the block of time steps
+            K: number of time steps in the block
+        out : (N_alpha, S, time, N_rec) numpy.ndarray
+            array in which the states are recorded
+        rec_idx : (K,) numpy.ndarray
+            index along the time axis of 'out' at which the states of each
+            time step in the block are recorded (-1 if not recorded)
+        rec_nodes : (N_rec,) numpy.ndarray, optional
+            nodes whose states are recorded, by default all nodes
+        kwargs :
+            keyword arguments of self.activation_function
+        """
+        activation = self.activation_function.__name__
+        kernel = _kernels.get_esn_kernel(activation,
+                                         sparse=sp.issparse(self.w))
+
+        # keyword arguments of the activation function (with their defaults)
+        # in the order of its signature
+        args = inspect.signature(self.activation_function).bind(
+            None, **kwargs)
+        args.apply_defaults()
+        del args.arguments['out']
+        params = np.array(args.args[1:], dtype=float)
+
+        if rec_nodes is None:
+            rec_nodes = np.arange(self.n_nodes)
+
+        # all sequences of all spectral scalings are simulated as a single
+        # (N_alpha * S, N) block of states
+        n_alpha, n_seq, _ = x.shape
+        x = x.reshape(-1, self.n_nodes)
+        out = out.reshape(n_alpha * n_seq, *out.shape[2:])
+        alphas = np.repeat(alphas.ravel(), n_seq)
+
+        drive = np.ascontiguousarray(drive)
+        if sp.issparse(self.w):
+            kernel(x, self.w.data, self.w.indices, self.w.indptr, alphas,
+                   drive, rec_idx, rec_nodes, out, params)
+        else:
+            kernel(x, np.ascontiguousarray(self.w), alphas, drive, rec_idx,
+                   rec_nodes, out, params)
+
+    def set_activation_function(self, function):
+        """
+        Returns the activation function of the reservoir's units
+
+        Activation functions are vectorized callables f(x, out=None,
+        **kwargs) that write f(x) into 'out' (allocated if None) and
+        return it, such that the simulation writes the new states into a
+        preallocated array at every time step. If 'out' is given, x may be
+        used as scratch space (i.e., it may be overwritten), and 'out' may
+        be x itself to compute the activation in place.
+
+        Parameters
+        ----------
+        function : str or callable
+            Name of a built-in activation function {'linear', 'elu', 'relu',
+            'leaky_relu', 'sigmoid', 'tanh', 'step'}, or a vectorized
+            callable f(x, **kwargs). If the callable has no 'out' argument,
+            its result is copied into 'out' (which allocates an array at
+            every time step).
+
+        Returns
+        -------
+        activation_function : callable
+            activation function f(x, out=None, **kwargs)
+        """
+
+        def linear(x, m=1, out=None):
+            return np.multiply(x, m, out=out)
+
+        def elu(x, alpha=0.5, out=None):
+            # max(x, 0) is written into x as scratch space, unless 'out'
+            # is x itself (or not given)
+            if out is None or np.shares_memory(x, out):
+                pos = np.maximum(x, 0)
+                out = np.minimum(x, 0, out=out)
+            else:
+                np.minimum(x, 0, out=out)
+                pos = np.maximum(x, 0, out=x)
+            np.expm1(out, out=out)
+            out *= alpha
+            out += pos
+            return out
+
+        def relu(x, out=None):
+            return np.maximum(x, 0, out=out)
+
+        def leaky_relu(x, alpha=0.5, out=None):
+            if out is not None and np.shares_memory(x, out):
+                x = x.copy()
+            out = np.multiply(x, alpha, out=out)
+            return np.maximum(out, x, out=out)
+
+        def sigmoid(x, out=None):
+            out = np.negative(x, out=out)
+            np.exp(out, out=out)
+            out += 1
+            return np.reciprocal(out, out=out)
+
+        def tanh(x, out=None):
+            return np.tanh(x, out=out)
+
+        def step(x, thr=0.5, vmin=0, vmax=1, out=None):
+            # vmin and vmax are cast to int as the states are binary
+            if out is None:
+                out = np.empty_like(x)
+            np.greater_equal(x, thr, out=out, casting='unsafe')
+            out *= int(vmax) - int(vmin)
+            out += int(vmin)
+            return out
+
+        if callable(function):
+            if 'out' in inspect.signature(function).parameters:
+                return function
+
+            def wrapped(x, out=None, **kwargs):
+                if out is None:
+                    return function(x, **kwargs)
+                out[...] = function(x, **kwargs)
+                return out
+
+            wrapped.__name__ = function.__name__
+            return wrapped
+
+        if function == 'linear':
+            return linear
+        elif function == 'elu':
+            return elu
+        elif function == 'relu':
+            return relu
+        elif function == 'leaky_relu':
+            return leaky_relu
+        elif function == 'sigmoid':
+            return sigmoid
+        elif function == 'tanh':
+            return tanh
+        elif function == 'step':
+            return step
+
+
+class EchoStateNetworkEnsemble(EchoStateNetwork):
+    """
+    Class that represents an ensemble of Echo State Networks (e.g., an
+    empirical network and its nulls) that share the same number of nodes,
+    activation function and input, and that are simulated together
+
+    ...
+
+    Attributes
+    ----------
+    w : (M, N, N) numpy.ndarray
+        stack of reservoir connectivity matrices (source, target)
+    _state : numpy.ndarray
+        reservoir activation states of all networks
+    n_nodes : int
+        dimension of each reservoir
+    n_networks : int
+        number of networks in the ensemble
+
+    Methods
+    -------
+    # TODO
+
+    simulate
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Constructor class for ensembles of Echo State Networks
+
+        Parameters
+        ----------
+        w: (M, N, N) numpy.ndarray
+            Stack of reservoir connectivity matrices (source, target)
+            M: number of networks in the ensemble
+            N: number of nodes in each network. If w is directed, then rows
+            (columns) should correspond to source (target) nodes.
+        kwargs:
+            Other keyword arguments are passed to EchoStateNetwork (note
+            that only the dense numpy backend is supported)
+        """
+        if kwargs.get('sparse', False) or \
+                kwargs.get('backend', 'numpy') != 'numpy':
+            raise ValueError('EchoStateNetworkEnsemble only supports dense '
+                             'connectivity and the numpy backend')
+
+        super().__init__(*args, **kwargs)
+
+        if self.w.ndim != 3:
+            raise ValueError('w must be a (M, N, N) stack of connectivity '
+                             'matrices')
+
+        self.n_networks, _, self.n_nodes = self.w.shape
+
+    def _recurrent_input(self, x, out=None):
+        """
+        Computes the recurrent input of all networks with a single batched
+        matrix product. States are ordered network by network along the
+        first axis (see self.simulate).
+        """
+        if out is None:
+            out = np.empty(x.shape, dtype=np.result_type(x, self.w))
+        np.matmul(x.reshape(self.n_networks, -1, self.n_nodes), self.w,
+                  out=out.reshape(self.n_networks, -1, self.n_nodes))
+        return out
+
+    def simulate(self, *args, alphas=None, return_states=True, **kwargs):
+        """
+        Simulates the dynamics of all networks in the ensemble given a
+        shared external input signal. All M networks are advanced together,
+        such that each time step requires one batched matrix product
+        (numpy.matmul) over the whole ensemble, and the input drive is
+        computed only once.
+
+        Parameters
+        ----------
+        args, kwargs:
+            Same as EchoStateNetwork.simulate. Initial conditions 'ic' of
+            shape (N,) are shared by all networks.
+        alphas : float or (N_alpha,) array_like, optional
+            Spectral scaling(s) applied to every network in the ensemble
+        return_states : bool, optional
+            If True, simulated reservoir states are returned. True by
+            default.
+
+        Returns
+        -------
+        states : generator
+            Generator that yields, network by network, the same output as
+            EchoStateNetwork.simulate would return for that network. Arrays
+            are views into the output of the whole ensemble, i.e., they are
+            not copied network by network. Note that with 'output_nodes'
+            and save_state=True (default), that output is a copy of the
+            output nodes of all networks made after simulating; use
+            save_state=False to only record the output nodes instead.
+        """
+        batch_alpha = alphas is not None and np.ndim(alphas) > 0
+        alphas = np.atleast_1d(1.0 if alphas is None else alphas)
+
+        # spectral scalings of all networks, network by network
+        states = super().simulate(
+            *args, alphas=np.tile(alphas, self.n_networks),
+            return_states=return_states, **kwargs
+        )
+
+        if return_states:
+            return self._iter_networks(states, len(alphas), batch_alpha)
+
+    def _iter_networks(self, states, n_alpha, batch_alpha):
+        """
+        Yields the states of each network in the ensemble
+
+        Parameters
+        ----------
+        states : numpy.ndarray or list
+            states of all networks and spectral scalings (see
+            EchoStateNetwork.simulate)
+        n_alpha : int
+            number of spectral scalings per network
+        batch_alpha : bool
+            whether several spectral scalings were simulated
+        """
+        for i in range(self.n_networks):
+            network_states = states[i * n_alpha:(i + 1) * n_alpha]
+            yield network_states if batch_alpha else network_states[0]
+
+
+class LinearEchoStateNetwork(EchoStateNetwork):
+    """
+    Class that represents an Echo State Network with a linear activation
+    function, i.e., x(t) = m * (alpha * x(t-1) @ w + u(t) @ w_in). Since
+    the states are a linear filter of the input, they are computed in
+    closed form instead of time step by time step, and the memory capacity
+    can be computed analytically.
+
+    ...
+
+    Attributes
+    ----------
+    w : numpy.ndarray or scipy.sparse.csc_matrix
+        reservoir connectivity matrix (source, target)
+    _state : numpy.ndarray
+        reservoir activation states
+    n_nodes : int
+        dimension of the reservoir
+    method : {'fft', 'eig'}
+        closed-form solution used to compute the states
+    tol : float
+        relative norm below which impulse responses are truncated
+
+    Methods
+    -------
+    # TODO
+
+    simulate
+
+    memory_capacity
+
+    """
+
+    def __init__(self, *args, method='fft', tol=1e-10, **kwargs):
+        """
+        Constructor class for linear Echo State Networks
+
+        Parameters
+        ----------
+        w: (N, N) numpy.ndarray or scipy.sparse matrix
+            Reservoir connectivity matrix (source, target)
+            N: number of nodes in the network. If w is directed, then rows
+            (columns) should correspond to source (target) nodes.
+        method : {'fft', 'eig'}, optional
+            If 'fft', the states are computed by FFT convolution of the
+            input with the impulse response m * w_in @ (m * alpha * w)^k,
+            truncated once its norm decays below 'tol' (relative to k=0).
+            If 'eig', the states are computed in the eigenbasis of w, where
+            the dynamics decouple into N scalar filters that are applied by
+            FFT convolution. The eigendecomposition is shared by all
+            spectral scalings, but it is inaccurate if w is close to
+            defective. A precomputed drive (see self.input_drive()) is
+            always simulated with 'eig'. By default 'fft'.
+        tol : float, optional
+            Relative norm below which impulse responses (including the
+            decay of the initial conditions) are truncated, by default
+            1e-10
+        kwargs:
+            Other keyword arguments are passed to EchoStateNetwork (note
+            that the activation function is always linear, with its slope
+            'm' passed to self.simulate)
+        """
+        if kwargs.pop('activation_function', 'linear') != 'linear':
+            raise ValueError('LinearEchoStateNetwork only supports the '
+                             'linear activation function')
+        if method not in ['fft', 'eig']:
+            raise ValueError("method must be 'fft' or 'eig'")
+
+        super().__init__(*args, activation_function='linear', **kwargs)
+
+        self.method = method
+        self.tol = tol
+
+    def _dense_w(self):
+        if sp.issparse(self.w):
+            return self.w.toarray().astype(np.float64)
+        return np.asarray(self.w, dtype=np.float64)
+
+    def _impulse_response(self, w_in, a, n_max):
+        """
+        Returns the impulse response w_in @ a^k for k = 0, 1, ...,
+        truncated once its norm decays below self.tol (relative to k=0)
+        or after n_max lags
+        """
+        response = [w_in]
+        norm = self.tol * np.linalg.norm(w_in)
+        for _ in range(1, n_max):
+            g = response[-1] @ a
+            if np.linalg.norm(g) <= norm:
+                break
+            response.append(g)
+
+        return np.stack(response)
+
+    def _run(self, x, alphas, ext_input, w_in, states, rec_idx,
+             rec_nodes=None, m=1):
+        """
+        Computes the states of all time steps in closed form and records
+        them (see EchoStateNetwork._run). Note that the states of all
+        nodes and time steps are held in memory for one spectral scaling
+        at a time.
+        """
+        if len(ext_input) == 0:
+            return x
+
+        if self.method == 'eig' or w_in is None:
+            solutions = self._solve_eig(x, alphas, ext_input, w_in, m)
+        else:
+            solutions = self._solve_fft(x, alphas, ext_input, w_in, m)
+
+        # recorded time steps are contiguous in 'states'
+        keep = rec_idx >= 0
+        for i, x_t in enumerate(solutions):
+            if rec_nodes is not None:
+                states[i] = np.swapaxes(x_t[keep][..., rec_nodes], 0, 1)
+            else:
+                states[i] = np.swapaxes(x_t[keep], 0, 1)
+            x[i] = x_t[-1]
+
+        return x
+
+    def _solve_eig(self, x, alphas, ext_input, w_in, m):
+        """
+        Yields x(t) = x(0) @ a^t + m * sum_k drive(t-k) @ a^k for each
+        a = m * alpha * w, computed in the eigenbasis of w (shared by all
+        alphas), where the dynamics decouple into scalar filters with
+        impulse response mu^k for each eigenvalue mu of a
+        """
+        n_timesteps, n_seq, _ = ext_input.shape
+        drive = ext_input if w_in is None else ext_input @ w_in
+
+        lam, v = np.linalg.eig(self._dense_w())
+        lam = lam.astype(complex)
+        v_inv = np.linalg.inv(v)
+        v_re, v_im = np.real(v).copy(), np.imag(v).copy()
+        v_inv_re, v_inv_im = np.real(v_inv).copy(), np.imag(v_inv).copy()
+
+        # spectrum of the drive in the eigenbasis; products with v are
+        # computed on real (time * S, N) matrices rather than on a stack
+        # of complex (S, N) matrices
+        n_fft = sp_fft.next_fast_len(2 * n_timesteps - 1)
+        drive = m * drive.reshape(-1, self.n_nodes)
+        z_hat = sp_fft.fft(
+            (drive @ v_re + 1j * (drive @ v_im)).reshape(
+                n_timesteps, n_seq, -1),
+            n=n_fft, axis=0)
+        z_0 = x @ v_re + 1j * (x @ v_im)
+
+        k = np.arange(n_timesteps + 1)[:, np.newaxis]
+        for i, alpha in enumerate(alphas.ravel()):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mu_pow = np.exp(k * np.log(m * float(alpha) * lam))
+            mu_pow[0] = 1
+
+            z = sp_fft.ifft(
+                z_hat * sp_fft.fft(mu_pow[:-1], n=n_fft, axis=0)[
+                    :, np.newaxis],
+                axis=0)[:n_timesteps]
+            z += z_0[i] * mu_pow[1:, np.newaxis]
+
+            # only the real part of the states is needed
+            z = z.reshape(-1, self.n_nodes)
+            yield (np.real(z).copy() @ v_inv_re
+                   - np.imag(z).copy() @ v_inv_im).reshape(
+                n_timesteps, n_seq, -1)
+
+    def _solve_fft(self, x, alphas, ext_input, w_in, m):
+        """
+        Yields x(t) = x(0) @ a^t + sum_k u(t-k) @ (m * w_in @ a^k) for each
+        a = m * alpha * w, computed by FFT convolution with the truncated
+        impulse response
+        """
+        n_timesteps, n_seq, n_inputs = ext_input.shape
+        w_in = m * np.asarray(w_in, dtype=np.float64)
+
+        w = self._dense_w()
+        for i, alpha in enumerate(alphas.ravel()):
+            a = m * float(alpha) * w
+            response = self._impulse_response(w_in, a, n_timesteps)
+
+            x_t = np.zeros((n_timesteps, n_seq, self.n_nodes))
+            for j in range(n_inputs):
+                x_t += fftconvolve(ext_input[:, :, j, np.newaxis],
+                                   response[:, np.newaxis, j],
+                                   axes=0)[:n_timesteps]
+
+            # decay of the initial conditions
+            norm = self.tol * np.linalg.norm(x[i])
+            state = x[i].astype(np.float64)
+            for t in range(n_timesteps):
+                state = state @ a
+                if np.linalg.norm(state) <= norm:
+                    break
+                x_t[t] += state
+
+            yield x_t
+
+    def memory_capacity(self, w_in, horizon_max=-20, alphas=None, m=1,
+                        output_nodes=None, n_max=10000):
+        """
+        Computes the memory capacity analytically for an i.i.d. zero-mean
+        input signal, i.e., the squared correlation between the input
+        delayed by k time steps and its optimal linear reconstruction from
+        the reservoir states, for k = 1, ..., abs(horizon_max) (see the
+        MemoryCapacity task in conn2res.tasks). Given the impulse response
+        g_k = m * w_in @ (m * alpha * w)^k and the state covariance
+        C = sum_k g_k.T @ g_k, the capacity at lag k is
+        g_k @ pinv(C) @ g_k.T. The dynamics should have the echo state
+        property (i.e., spectral radius of m * alpha * w below 1).
+
+        Parameters
+        ----------
+        w_in : (1, N) or (N,) numpy.ndarray
+            Input connectivity matrix of a single input signal
+        horizon_max : int, optional
+            Maximum delay, by default -20
+        alphas : float or (N_alpha,) array_like, optional
+            Spectral scaling(s) applied to the reservoir connectivity
+            matrix, by default None, i.e., w is used as is
+        m : float, optional
+            Slope of the linear activation function, by default 1
+        output_nodes : list or numpy.ndarray, optional
+            Nodes whose states are used by the readout, by default all
+            nodes
+        n_max : int, optional
+            Maximum number of lags of the impulse response, by default
+            10000
+
+        Returns
+        -------
+        mc : (abs(horizon_max),) or (N_alpha, abs(horizon_max))
+        numpy.ndarray
+            Memory capacity at each delay; the total memory capacity is
+            given by its sum. If 'alphas' is array_like, capacities are
+            stacked along the first axis (one entry per alpha).
+
+        Raises
+        ------
+        ValueError
+            if w_in projects more than one input signal
+        """
+        w_in = np.atleast_2d(np.asarray(w_in, dtype=np.float64))
+        if w_in.shape[0] != 1:
+            raise ValueError('memory capacity is only defined for a single '
+                             'input signal')
+
+        batch_alpha = alphas is not None and np.ndim(alphas) > 0
+        if alphas is None:
+            alphas = 1.0
+
+        lags = np.arange(1, np.abs(horizon_max) + 1)
+        w = self._dense_w()
+        mc = np.zeros((np.size(alphas), len(lags)))
+        for i, alpha in enumerate(np.atleast_1d(alphas)):
+            response = self._impulse_response(
+                m * w_in[0], m * float(alpha) * w, n_max)
+            if output_nodes is not None:
+                response = response[:, output_nodes]
+
+            # lags beyond the truncated impulse response are not remembered
+            g = np.zeros((max(len(response), len(lags) + 1),
+                          response.shape[1]))
+            g[:len(response)] = response
+            cov = response.T @ response
+            mc[i] = np.einsum('kn,nm,km->k', g[lags], pinv(cov), g[lags])
+
+        if not batch_alpha:
+            return mc[0]
+        return mc
+
+
+class _SpikeBuffer:
+    """
+    Buffer of spike events (neuron indices and time steps) whose capacity
+    grows geometrically, such that appending spikes takes amortized
+    constant time per spike
+    """
+
+    def __init__(self, capacity=4096):
+        self.indices = np.empty(capacity, dtype=np.int32)
+        self.steps = np.empty(capacity, dtype=np.int32)
+        self.size = 0
+
+    def append(self, indices, step):
+        """
+        Appends the spikes of neurons 'indices' at time step 'step'
+        """
+        size = self.size + len(indices)
+        if size > len(self.indices):
+            capacity = max(size, 2 * len(self.indices))
+            self.indices = np.resize(self.indices, capacity)
+            self.steps = np.resize(self.steps, capacity)
+
+        self.indices[self.size:size] = indices
+        self.steps[self.size:size] = step
+        self.size = size
+
+    def finalize(self):
+        """
+        Returns the neuron indices and time steps of all spikes
+        """
+        return self.indices[:self.size].copy(), self.steps[:self.size].copy()
+
+
+class SpikeRaster:
+    """
+    Class that represents the spike raster of a spiking neural network as
+    an event list in compressed sparse row (CSR) format: the neurons that
+    spike at time step i are indices[indptr[i]:indptr[i + 1]]. Memory scales
+    with the number of spikes rather than with N x nt.
+
+    ...
+
+    Attributes
+    ----------
+    indices : (N_spikes,) numpy.ndarray
+        neuron indices of the spikes (int32), ordered by time step
+    indptr : (nt + 1,) numpy.ndarray
+        offsets of the spikes of each time step in 'indices'
+    n_nodes : int
+        number of neurons
+    dt : float
+        sampling rate (in s)
+
+    Methods
+    -------
+    # TODO
+
+    from_events
+
+    events
+
+    counts
+
+    to_dense
+
+    to_packed
+
+    to_tspike
+
+    save
+
+    load
+
+    """
+
+    def __init__(self, indices, indptr, n_nodes, dt=1.0):
+        """
+        Constructor class for spike rasters
+
+        Parameters
+        ----------
+        indices : (N_spikes,) numpy.ndarray
+            Neuron indices of the spikes, ordered by time step
+        indptr : (nt + 1,) numpy.ndarray
+            Offsets of the spikes of each time step in 'indices'
+            nt: number of time steps
+        n_nodes : int
+            Number of neurons
+        dt : float, optional
+            Sampling rate (in s), by default 1
+        """
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.n_nodes = int(n_nodes)
+        self.dt = dt
+
+        if len(self.indptr) == 0 or self.indptr[-1] != len(self.indices):
+            raise ValueError('indptr does not match the number of spikes')
+
+    @classmethod
+    def from_events(cls, indices, steps, n_nodes, n_steps, dt=1.0):
+        """
+        Creates a spike raster from spike events
+
+        Parameters
+        ----------
+        indices : (N_spikes,) numpy.ndarray
+            Neuron indices of the spikes
+        steps : (N_spikes,) numpy.ndarray
+            Time steps of the spikes
+        n_nodes : int
+            Number of neurons
+        n_steps : int
+            Number of time steps
+        dt : float, optional
+            Sampling rate (in s), by default 1
+
+        Returns
+        -------
+        SpikeRaster
+        """
+        steps = np.asarray(steps)
+        order = np.argsort(steps, kind='stable')
+        indptr = np.zeros(n_steps + 1, dtype=np.int64)
+        np.cumsum(np.bincount(steps, minlength=n_steps), out=indptr[1:])
+
+        return cls(np.asarray(indices)[order], indptr, n_nodes, dt)
+
+    @property
+    def n_steps(self):
+        """number of time steps"""
+        return len(self.indptr) - 1
+
+    @property
+    def steps(self):
+        """time steps of the spikes (int32), ordered by time step"""
+        return self.events()[1]
+
+    def events(self, start=None, stop=None):
+        """
+        Returns the spikes within time steps [start, stop)
+
+        Parameters
+        ----------
+        start, stop : int, optional
+            First and last (excluded) time step, by default all time steps
+
+        Returns
+        -------
+        indices, steps : (N_spikes,) numpy.ndarray
+            neuron indices and time steps of the spikes
+        """
+        start, stop, _ = slice(start, stop).indices(self.n_steps)
+        stop = max(start, stop)
+        steps = np.repeat(np.arange(start, stop, dtype=np.int32),
+                          np.diff(self.indptr[start:stop + 1]))
+
+        return self.indices[self.indptr[start]:self.indptr[stop]], steps
+
+    def counts(self, start=None, stop=None):
+        """
+        Returns the number of spikes of each neuron within time steps
+        [start, stop)
+
+        Parameters
+        ----------
+        start, stop : int, optional
+            First and last (excluded) time step, by default all time steps
+
+        Returns
+        -------
+        counts : (N,) numpy.ndarray
+            number of spikes of each neuron
+        """
+        start, stop, _ = slice(start, stop).indices(self.n_steps)
+        return np.bincount(
+            self.indices[self.indptr[start]:self.indptr[max(start, stop)]],
+            minlength=self.n_nodes)
+
+    def to_dense(self, dtype=bool):
+        """
+        Returns the spike raster as a dense (N, nt) numpy.ndarray
+        """
+        raster = np.zeros((self.n_nodes, self.n_steps), dtype=dtype)
+        raster[self.indices, self.steps] = 1
+        return raster
+
+    def to_packed(self):
+        """
+        Returns the spike raster as a bit-packed (N, ceil(nt / 8)) uint8
+        numpy.ndarray, which can be unpacked with
+        numpy.unpackbits(packed, axis=1, count=nt)
+        """
+        packed = np.zeros((self.n_nodes, -(-self.n_steps // 8)),
+                          dtype=np.uint8)
+        steps = self.steps
+        np.bitwise_or.at(packed, (self.indices, steps // 8),
+                         (128 >> (steps % 8)).astype(np.uint8))
+        return packed
+
+    def to_tspike(self):
+        """
+        Returns the (N_spikes, 2) array of neuron indices and spike times
+        (in s), i.e., SpikingNeuralNetwork.tspike
+        """
+        return np.column_stack((self.indices, self.steps * self.dt))
+
+    def save(self, fname):
+        """
+        Saves the spike raster to a .npz file
+        """
+        np.savez(fname, indices=self.indices, indptr=self.indptr,
+                 n_nodes=self.n_nodes, dt=self.dt)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Loads a spike raster saved with SpikeRaster.save()
+        """
+        with np.load(fname) as data:
+            return cls(data['indices'], data['indptr'],
+                       int(data['n_nodes']), float(data['dt']))
+
+
+class Stimulation:
+    """
+    Class that represents a protocol of artificial stimulation or
+    inhibition of a spiking neural network (modelling optogenetic
+    stimulation): at every time step within [onset, offset), the membrane
+    voltage of the stimulated neurons is shifted by 'amplitude' with
+    probability 'probability'. The protocol is validated once, when it is
+    created, and several protocols can be applied concurrently (see
+    SpikingNeuralNetwork.simulate).
+
+    ...
+
+    Attributes
+    ----------
+    units : (N_stim,) numpy.ndarray
+        sorted unique indices of the stimulated neurons
+    onset : int
+        first time step of the stimulation
+    offset : int
+        time step at which the stimulation ends (exclusive)
+    amplitude : float
+        voltage shift (in mV); positive values are depolarizing
+        (stimulation) and negative values hyperpolarizing (inhibition)
+    probability : float
+        probability of applying the stimulation at each time step
+
+    Methods
+    -------
+    # TODO
+
+    from_stim_mode
+
+    """
+
+    def __init__(self, units, onset, offset, amplitude=0.5, probability=0.5):
+        """
+        Constructor class for stimulation protocols
+
+        Parameters
+        ----------
+        units : array_like
+            Indices of the stimulated neurons
+        onset : int
+            First time step of the stimulation
+        offset : int
+            Time step at which the stimulation ends (exclusive)
+        amplitude : float, optional
+            Voltage shift (in mV), by default 0.5
+        probability : float, optional
+            Probability of applying the stimulation at each time step, by
+            default 0.5
+        """
+        units = np.asarray(units)
+        if units.ndim != 1 or not (units.size == 0 or
+                                   np.issubdtype(units.dtype, np.integer)):
+            raise TypeError('units must be a 1D array of integers')
+        if np.any(units < 0):
+            raise ValueError('units must be non-negative')
+        if not (0 <= onset <= offset):
+            raise ValueError('onset and offset must satisfy '
+                             '0 <= onset <= offset')
+        if not (0 <= probability <= 1):
+            raise ValueError('probability must be in the range [0, 1]')
+
+        self.units = np.unique(units).astype(np.int64)
+        self.onset = int(onset)
+        self.offset = int(offset)
+        self.amplitude = float(amplitude)
+        self.probability = float(probability)
+
+    @classmethod
+    def from_stim_mode(cls, stim_mode, stim_dur, stim_units, stim_val=0.5):
+        """
+        Creates the stimulation protocol given by the arguments stim_mode,
+        stim_dur, stim_units and stim_val of SpikingNeuralNetwork.simulate
+
+        Returns
+        -------
+        Stimulation
         """
-        # print('\n GENERATING RESERVOIR STATES ...')
+        if stim_mode not in ('exc', 'inh'):
+            raise ValueError("stim_mode must be 'exc' or 'inh'")
+        if stim_dur is None:
+            raise ValueError('stim_dur not specified')
+        if stim_units is None:
+            raise ValueError('stim_units not specified')
 
-        # if ext_input is list or tuple convert to numpy.ndarray
-        if isinstance(ext_input, (list, tuple)):
-            sections = utils.get_sections(ext_input)
-            ext_input = utils.concat(ext_input)
-            convert_to_list = True
-        else:
-            convert_to_list = False
+        return cls(stim_units, stim_dur[0], stim_dur[1],
+                   amplitude=stim_val if stim_mode == 'exc' else -stim_val)
 
-        # initialize reservoir states
-        timesteps = range(1, len(ext_input) + 1)
-        self._state = np.zeros((len(timesteps) + 1, self.n_nodes))
 
-        # set initial conditions
-        if ic is not None:
-            self._state[0, :] = ic
+class _StimulationSchedule:
+    """
+    Stimulation protocols of the replicas of a SpikingNeuralNetwork
+    compiled for its time loop. The stimulated neurons of protocol p are
+    units[ptr[p]:ptr[p + 1]] (as flat indices b * N + neuron of replica
+    b), and its Bernoulli masks are drawn in blocks of time steps.
+    """
 
-        # simulate dynamics
-        for t in timesteps:
-            # if (t > 0) and (t % 100 == 0):
-            #     print(f'\t ----- timestep = {t}')
-            synap_input = np.dot(
-                self._state[t-1, :], self.w) + np.dot(ext_input[t-1, :], w_in)
-            self._state[t, :] = self.activation_function(synap_input, **kwargs)
+    def __init__(self, stims, n_nodes, dtype=np.float64):
+        # stims: list with the list of Stimulation of each replica
+        protocols = [(b, stim) for b, replica in enumerate(stims)
+                     for stim in replica]
+        for _, stim in protocols:
+            if len(stim.units) > 0 and stim.units[-1] >= n_nodes:
+                raise ValueError('stimulated units exceed the number of '
+                                 'neurons')
+
+        self.n_batch = len(stims)
+        self.n_nodes = n_nodes
+        self.dtype = np.dtype(dtype)
+        self.replica = np.array([b for b, _ in protocols], dtype=np.int64)
+        self.onset = np.array([stim.onset for _, stim in protocols])
+        self.offset = np.array([stim.offset for _, stim in protocols])
+        self.amplitude = np.array([stim.amplitude for _, stim in protocols])
+        self.probability = np.array([stim.probability
+                                     for _, stim in protocols])
+        self.ptr = np.cumsum([0] + [len(stim.units) for _, stim in protocols])
+        self.units = np.concatenate(
+            [b * n_nodes + stim.units for b, stim in protocols] +
+            [np.zeros(0, dtype=np.int64)])
+
+    def __len__(self):
+        return len(self.replica)
+
+    def masks(self, rng, start, n_steps):
+        """
+        Returns the (n_steps, P) Bernoulli masks of the P protocols at time
+        steps [start, start + n_steps), which are False outside of their
+        [onset, offset) intervals
+        """
+        steps = np.arange(start, start + n_steps)[:, np.newaxis]
+        return (rng.random((n_steps, len(self))) < self.probability) \
+            & (self.onset <= steps) & (steps < self.offset)
 
-        # remove initial condition (to match the time index of _state
-        # and ext_input)
-        self._state = self._state[1:]
+    def drive(self, mask):
+        """
+        Returns the (B, N) voltage shifts of the protocols in 'mask' (P,)
+        """
+        protocols = np.flatnonzero(mask)
+        starts, counts = self.ptr[protocols], np.diff(self.ptr)[protocols]
+        pos = np.arange(counts.sum()) + np.repeat(
+            starts - np.cumsum(counts) + counts, counts)
+        return np.bincount(
+            self.units[pos], weights=np.repeat(self.amplitude[protocols],
+                                               counts),
+            minlength=self.n_batch * self.n_nodes
+        ).reshape(self.n_batch, self.n_nodes).astype(self.dtype)
+
+
+def _rng_state(rng):
+    """
+    Returns the state of the random number generator 'rng' as a JSON string,
+    with the arrays of the state (e.g., of MT19937) converted to lists, such
+    that it can be saved to and loaded from a .npz file without pickle
+    """
+    return json.dumps(rng.bit_generator.state, default=np.ndarray.tolist)
 
-        # convert back to list or tuple
-        if convert_to_list:
-            self._state = utils.split(self._state, sections)
 
-        # return the same type
-        if return_states:
-            if output_nodes is not None:
-                if convert_to_list:
-                    return [state[:, output_nodes] for state in self._state]
-                else:
-                    return self._state[:, output_nodes]
-            else:
-                return self._state
+def _rng_from_state(state):
+    """
+    Returns a random number generator from a state saved with _rng_state()
+    """
+    state = json.loads(str(state))
+    bit_generator = getattr(np.random, state['bit_generator'])()
+    bit_generator.state = state
+    return np.random.Generator(bit_generator)
 
-    def set_activation_function(self, function):
 
-        def linear(x, m=1):
-            return m * x
+def _fingerprint(*arrays):
+    """
+    Returns a digest of the dtypes, shapes and contents of 'arrays', e.g., to
+    check that a checkpoint belongs to the same simulation
+    """
+    digest = hashlib.sha256()
+    for x in arrays:
+        x = np.ascontiguousarray(x)
+        digest.update(f'{x.dtype}{x.shape}'.encode())
+        digest.update(x.tobytes())
+    return digest.hexdigest()
 
-        def elu(x, alpha=0.5):
-            x[x <= 0] = alpha*(np.exp(x[x <= 0]) - 1)
-            return x
 
-        def relu(x):
-            return np.maximum(0, x)
+class LIFState:
+    """
+    Class that represents the state of the LIF neurons of B replicas of a
+    SpikingNeuralNetwork at a given time step, including the random number
+    generators of the noise and stimulation, such that a simulation can be
+    resumed from it (see the 'checkpoint' argument of
+    SpikingNeuralNetwork.simulate). The state is kept in preallocated
+    (B, N) arrays, which the time loop updates in place and which are
+    reused by consecutive simulations of the same shape.
 
-        def leaky_relu(x, alpha=0.5):
-            return np.maximum(alpha * x, x)
+    ...
 
-        def sigmoid(x):
-            return 1.0 / (1 + np.exp(-x))
+    Attributes
+    ----------
+    v : (B, N) numpy.ndarray
+        membrane voltage (mV)
+    IPSC : (B, N) numpy.ndarray
+        post synaptic current
+    h : (B, N) numpy.ndarray
+        filtered firing rates (synaptic input accumulation)
+    r : (B, N) numpy.ndarray
+        filtered firing rates
+    hr : (B, N) numpy.ndarray
+        filtered firing rates (rising phase)
+    refractory : (B, N) numpy.ndarray
+        remaining refractory time steps (int32)
+    step : int
+        time step from which the simulation continues
+    noise_rng : numpy.random.Generator
+        random number generator of the noise
+    stim_rng : numpy.random.Generator
+        random number generator of the stimulation
 
-        def tanh(x):
-            return np.tanh(x)
+    Methods
+    -------
+    # TODO
 
-        def step(x, thr=0.5, vmin=0, vmax=1):
-            return np.piecewise(x, [x < thr, x >= thr], [vmin, vmax]).astype(int)
+    reset
 
-        if function == 'linear':
-            return linear
-        elif function == 'elu':
-            return elu
-        elif function == 'relu':
-            return relu
-        elif function == 'leaky_relu':
-            return leaky_relu
-        elif function == 'sigmoid':
-            return sigmoid
-        elif function == 'tanh':
-            return tanh
-        elif function == 'step':
-            return step
+    save
+
+    load
+
+    """
+
+    # arrays that make up the state (the others are work arrays)
+    FIELDS = ('v', 'IPSC', 'h', 'r', 'hr', 'refractory')
+
+    def __init__(self, n_batch, n_nodes, dtype=np.float64):
+        """
+        Constructor class for LIF states
+
+        Parameters
+        ----------
+        n_batch : int
+            Number of replicas
+        n_nodes : int
+            Number of neurons
+        dtype : numpy.dtype, optional
+            Floating point precision, by default numpy.float64
+        """
+        shape = (n_batch, n_nodes)
+        self.v = np.zeros(shape, dtype=dtype)
+        self.IPSC = np.zeros(shape, dtype=dtype)
+        self.h = np.zeros(shape, dtype=dtype)
+        self.r = np.zeros(shape, dtype=dtype)
+        self.hr = np.zeros(shape, dtype=dtype)
+        self.refractory = np.zeros(shape, dtype=np.int32)
+        self.step = 0
+        self.noise_rng = None
+        self.stim_rng = None
+        # work arrays of a time step: synaptic current, voltage change,
+        # contributions of the spiking neurons to IPSC, terms of the
+        # synaptic filter and spike mask
+        self.I = np.zeros(shape, dtype=dtype)
+        self.dv = np.zeros(shape, dtype=dtype)
+        self.JD = np.zeros(shape, dtype=dtype)
+        self.tmp = np.zeros(shape, dtype=dtype)
+        self.spiking = np.zeros(shape, dtype=bool)
+
+    @property
+    def shape(self):
+        return self.v.shape
+
+    @property
+    def dtype(self):
+        return self.v.dtype
+
+    def reset(self, v, refractory, noise_rng=None, stim_rng=None):
+        """
+        Sets the voltages to 'v', the refractory countdown to 'refractory'
+        and the random number generators, clears the synaptic filter and
+        rewinds to the first time step
+        """
+        self.v[:] = v
+        for x in (self.IPSC, self.h, self.r, self.hr):
+            x.fill(0)
+        self.refractory.fill(refractory)
+        self.step = 0
+        self.noise_rng = noise_rng
+        self.stim_rng = stim_rng
+
+    def save(self, fname):
+        """
+        Saves the state to a .npz file (fname may be a file object)
+        """
+        rngs = {name: _rng_state(getattr(self, name))
+                for name in ('noise_rng', 'stim_rng')}
+        np.savez(fname, step=self.step, **rngs,
+                 **{name: getattr(self, name) for name in self.FIELDS})
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Loads a state saved with LIFState.save()
+        """
+        with np.load(fname) as data:
+            state = cls(*data['v'].shape, dtype=data['v'].dtype)
+            for name in cls.FIELDS:
+                getattr(state, name)[:] = data[name]
+            state.step = int(data['step'])
+            for name in ('noise_rng', 'stim_rng'):
+                setattr(state, name, _rng_from_state(data[name]))
+
+        return state
 
 
 class SpikingNeuralNetwork(Reservoir):
@@ -253,7 +1743,7 @@ class SpikingNeuralNetwork(Reservoir):
 
     Attributes
     ----------
-    w : (N, N) numpy.ndarray
+    w : (N, N) numpy.ndarray or scipy.sparse.csc_matrix
         reservoir connectivity matrix (source, target)
         N: number of nodes in the network. If w is directed, then rows
         (columns) should correspond to source (target) nodes.
@@ -293,8 +1783,11 @@ class SpikingNeuralNetwork(Reservoir):
         post synaptic currents over time
         nt: number of time steps
         N: number of nodes in the network
+    spikes : SpikeRaster
+        spike raster as an event list
     spk : (N, nt) numpy.ndarray
-        spike raster
+        spike raster as a dense array (created from self.spikes whenever
+        it is accessed)
         nt: number of time steps
         N: number of nodes in the network
     rs : (N, nt/timescale) numpy.ndarray
@@ -302,12 +1795,21 @@ class SpikingNeuralNetwork(Reservoir):
         nt: number of time steps
         N: number of nodes in the network
         timescale: number of internal time steps per external time steps
+    spike_counts : (nt/timescale, N) numpy.ndarray
+        spike counts of every external time step (accumulated while
+        simulating; see self.firing_rates)
+    timescale : int
+        number of internal time steps per external time steps
     hs : (N, nt) numpy.ndarray
         filtered firing rates over time (synaptic input accumulation)
         nt: number of time steps
         N: number of nodes in the network
+        Note: REC, Is, IPSCs and hs are None if they are not
+        requested, and their time axis is decimated if requested (see
+        the 'record' argument of self.simulate)
     tspike : (N_spikes, 2) numpy.ndarray
-        spike times (in s)
+        spike times (in s), created from self.spikes whenever it is
+        accessed
         N_spikes: number of spikes
         tspike[:, 0]: spike neuronal indices
         tspike[:, 1]: spike times (in s)
@@ -320,6 +1822,14 @@ class SpikingNeuralNetwork(Reservoir):
     all_fr : (N,) numpy.ndarray
         average firing rates of all neurons
         N: number of neurons in the network
+    dtype : numpy.dtype
+        floating point precision of the simulation
+    rng : numpy.random.Generator
+        random number generator of the simulation
+    backend : {'numpy', 'numba'}
+        implementation of the time loop
+    state : LIFState
+        state of the neurons at the end of the last simulation
 
     Methods
     -------
@@ -327,9 +1837,15 @@ class SpikingNeuralNetwork(Reservoir):
 
     simulate
 
+    simulate_batch
+
+    firing_rates
+
     """
 
-    def __init__(self, *args, inh = 0.2, som = 0., apply_Dale = True, **kwargs):
+    def __init__(self, *args, inh = 0.2, som = 0., apply_Dale = True,
+                 sparse = False, dtype = np.float64, seed = None,
+                 backend = 'numpy', **kwargs):
         """
         Constructor class for Spiking Neural Networks
 
@@ -362,10 +1878,55 @@ class SpikingNeuralNetwork(Reservoir):
             common cortical microcircuit motif where somatostatin-expressing
             inhibitory neurons do not receive inhibitory input.
             Default: 0
+        sparse: bool or 'auto', optional
+            If True, the connectivity matrix is stored in CSC format and
+            spikes are propagated event by event, i.e., only the outgoing
+            weights of the spiking neurons are accumulated, such that the
+            cost per time step scales with the number of spikes times
+            their fan-out rather than with N times the number of spikes.
+            If 'auto', the sparse format is used under the same conditions
+            as in EchoStateNetwork. Connectivity matrices that are already
+            sparse are always kept sparse.
+            Default: False
+        dtype: numpy.dtype, optional
+            Floating point precision in which the connectivity matrix is
+            stored, the dynamics are simulated and the recordings are kept.
+            numpy.float32 halves the memory of all recordings.
+            Default: numpy.float64
+        seed : int, array_like[ints], SeedSequence, BitGenerator, Generator, optional
+            seed to initialize the random number generator (self.rng) that
+            draws the inhibitory and somatostatin-expressing neurons, the
+            initial voltages, the noise and the stimulation, by default None
+            for details, see numpy.random.default_rng(). If None, the seed
+            is drawn from numpy's global random state when the network is
+            built, such that numpy.random.seed() called before building the
+            network keeps it reproducible (calling it again before a
+            simulation has no effect)
+        backend: {'numpy', 'numba'}, optional
+            Implementation of the time loop. If 'numba', the whole LIF time
+            loop is JIT-compiled (requires numba) and the operations of each
+            time step are fused per neuron, which removes the interpreter
+            overhead of the many small array operations per time step. The
+            noise and stimulation are drawn as with 'numpy', but results
+            are only statistically equivalent due to floating point
+            rounding. The first simulation includes the compilation time.
+            Default: 'numpy'
         """
 
         super().__init__(*args, **kwargs)
 
+        if backend not in ('numpy', 'numba'):
+            raise ValueError("backend must be either 'numpy' or 'numba'")
+        if backend == 'numba':
+            _kernels.check_numba()
+        self.backend = backend
+
+        if seed is None:
+            seed = np.random.randint(2 ** 32)
+        self.rng = np.random.default_rng(seed=seed)
+        # state of the LIF neurons (see self._run)
+        self._lif = None
+
         if not(isinstance(inh, (float, np.ndarray))):
             raise TypeError('inh must be float or numpy.ndarray')
 
@@ -386,7 +1947,7 @@ class SpikingNeuralNetwork(Reservoir):
         else:
             if not (0 <= inh <= 1):
                 raise ValueError('inh and exc must be in the range [0, 1]')
-            inh = np.random.rand(self.n_nodes) < inh
+            inh = self.rng.random(self.n_nodes) < inh
             exc = ~inh
 
         if isinstance(som, np.ndarray):
@@ -399,32 +1960,248 @@ class SpikingNeuralNetwork(Reservoir):
             if som > 0:
                 som_size = int(np.round(som * np.sum(inh)))
                 som = np.zeros(self.n_nodes, dtype=bool)
-                som_idx = np.random.choice(np.where(inh)[0], som_size, replace=False)
+                som_idx = self.rng.choice(np.where(inh)[0], som_size, replace=False)
                 som[som_idx] = True
             else:
                 som = np.zeros(self.n_nodes, dtype=bool)
 
-        # apply Dale's principle if inhibitory neurons are specified
-        if np.any(inh):
-            w = np.abs(self.w)
+        self.sparse = sparse
+        self.dtype = np.dtype(dtype)
+        use_sparse = _use_sparse(self.w, sparse)
+        if use_sparse:
+            self.w = sp.csc_matrix(self.w)
 
-            # mask matrix imposing Dale's principle
-            mask = np.eye(self.n_nodes, dtype=np.float32)
-            mask[np.where(inh)[0], np.where(inh)[0]] = -1
+        # apply Dale's principle if inhibitory neurons are specified, i.e.,
+        # the outgoing weights (columns) of inhibitory neurons are negative
+        if np.any(inh):
+            sign = np.where(inh, -1, 1)
+            if use_sparse:
+                w = sp.csc_matrix(abs(self.w).multiply(sign[np.newaxis]))
+            else:
+                w = np.abs(self.w) * sign
 
-            # mask matrix imposing wiring motif mediated by
-            # somatostatin-expressing interneurons
-            som_mask = np.ones((self.n_nodes, self.n_nodes), dtype=np.float32)
+            # wiring motif mediated by somatostatin-expressing
+            # interneurons, which receive no inhibitory input
             if np.any(som):
-                for i in som_idx:
-                    som_mask[i, np.where(inh)[0]] = 0
+                if use_sparse:
+                    w = w.tocoo()
+                    keep = ~(som[w.row] & inh[w.col])
+                    w = sp.csc_matrix((w.data[keep], (w.row[keep],
+                                                      w.col[keep])),
+                                      shape=w.shape)
+                else:
+                    w[np.ix_(som, inh)] = 0
 
-            self.w = np.multiply(np.matmul(w, mask), som_mask)
+            self.w = w
+
+        if use_sparse:
+            self.w = sp.csc_matrix(self.w, dtype=self.dtype)
+        else:
+            self.w = np.asarray(self.w, dtype=self.dtype)
 
         self.inh = inh
         self.exc = exc
         self.som = som
 
+    @property
+    def spk(self):
+        if isinstance(self.spikes, list):
+            spk = [spikes.to_dense(dtype=self.dtype)
+                   for spikes in self.spikes]
+            if len({s.shape for s in spk}) > 1:
+                return spk
+            return np.stack(spk)
+        return self.spikes.to_dense(dtype=self.dtype)
+
+    @property
+    def tspike(self):
+        if isinstance(self.spikes, list):
+            return [spikes.to_tspike() for spikes in self.spikes]
+        return self.spikes.to_tspike()
+
+    @property
+    def state(self):
+        return self._lif
+
+    def firing_rates(self, window=None):
+        """
+        Returns the firing rates of all neurons (in Hz) over windows of
+        external time steps of the last simulation, computed from the spike
+        counts accumulated while simulating (self.spike_counts) rather than
+        from the spike raster
+
+        Parameters
+        ----------
+        window : int, 'trial' or array_like, optional
+            If None, the firing rates over the whole simulation.
+            If int k, the firing rates over consecutive windows of k
+            external time steps (the last window may be shorter), e.g.,
+            k=1 for the firing rates of every external time step.
+            If 'trial', the firing rates over each trial, i.e., each
+            element of a list or tuple 'ext_input' of self.simulate.
+            If array_like, the increasing edges of the windows (in external
+            time steps), e.g., [0, 10, 50] for the windows [0, 10) and
+            [10, 50).
+            Default: None
+
+        Returns
+        -------
+        rates : (N,) or (n_windows, N) numpy.ndarray
+            firing rates of each neuron (in each window). After
+            self.simulate_batch, rates have a leading replica axis (or are
+            a list of the rates of each replica if the replicas have
+            different numbers of time steps).
+            N: number of nodes in the network
+        """
+        if isinstance(self.spike_counts, list):
+            return [self._firing_rates(counts, window)
+                    for counts in self.spike_counts]
+        return self._firing_rates(self.spike_counts, window)
+
+    def _firing_rates(self, counts, window):
+        """
+        Returns the firing rates of self.firing_rates from the (..., time,
+        N) spike counts 'counts'
+        """
+        n_steps = counts.shape[-2]
+
+        if window is None:
+            edges = np.array([0, n_steps])
+        elif isinstance(window, str):
+            if window != 'trial':
+                raise ValueError("window must be None, int, 'trial' or "
+                                 "array_like")
+            if self._trials is None:
+                raise ValueError("window='trial' requires a list or tuple "
+                                 "ext_input")
+            edges = np.append(self._trials, n_steps)
+        elif isinstance(window, (int, np.integer)):
+            if window < 1:
+                raise ValueError('window must be a positive integer')
+            edges = np.append(np.arange(0, n_steps, window), n_steps)
+        else:
+            edges = np.asarray(window)
+            if edges.ndim != 1 or len(edges) < 2 or edges[0] < 0 \
+                    or edges[-1] > n_steps or np.any(np.diff(edges) <= 0):
+                raise ValueError('window edges must be increasing external '
+                                 'time steps within the simulation')
+
+        # spike counts summed over each window, divided by its duration
+        rates = np.add.reduceat(counts[..., :edges[-1], :], edges[:-1],
+                                axis=-2)
+        rates = rates / (np.diff(edges)[:, np.newaxis]
+                         * self.timescale * self.dt)
+
+        if window is None:
+            return rates[..., 0, :]
+        return rates
+
+    def _simulate_numba(self, start, stop, lif, ext_stim, rs, spike_counts,
+                        recordings, dec, spikes, block_size, noise, schedule,
+                        td, tr, dt, **params):
+        """
+        Runs the compiled time loop over time steps [start, stop) of the
+        replicas of self._run
+
+        The state of the neurons (LIFState 'lif'), the filtered firing
+        rates (rs), the spike counts and the recordings (REC, Is, IPSCs,
+        hs) are updated in place, and the spike events are appended to
+        'spikes'. The noise and the Bernoulli masks of the stimulation
+        'schedule' are drawn from the random number generators of 'lif' in
+        blocks of 'block_size' time steps, as in the numpy time loop.
+        'params' are the remaining (scalar) parameters of the LIF neurons
+        (see _kernels.get_lif_kernel).
+        """
+        sparse = sp.issparse(self.w)
+        kernel = _kernels.get_lif_kernel(sparse=sparse)
+        dtype = self.dtype
+        n_batch, n_nodes = lif.shape
+
+        if sparse:
+            w = (self.w.data, self.w.indices, self.w.indptr)
+        else:
+            empty = np.zeros(0, dtype=np.int32)
+            w = (np.ascontiguousarray(self.w.T), empty, empty)
+
+        # unused recordings are passed as empty arrays with a decimation
+        # factor of 0
+        recordings = [np.zeros((0, 0, 0), dtype=dtype) if rec is None
+                      else rec for rec in recordings]
+        dec = np.array([dec.get(name, 0) for name in SNN_RECORDINGS])
+
+        # parameters of the synaptic filter of each neuron
+        decay_td = np.exp(-dt / td)
+        tr_td = tr * td
+        decay_tr = np.exp(-dt / tr) if tr > 0 else 0.
+
+        # the stimulation protocols of replica b are
+        # stim_ptr[b]:stim_ptr[b + 1] (protocols are ordered by replica)
+        stim_ptr = np.searchsorted(schedule.replica, np.arange(n_batch + 1))
+        no_noise = np.zeros((0, n_batch, n_nodes), dtype=dtype)
+
+        for block in range(start, stop, block_size):
+            n_block = min(block_size, stop - block)
+            if noise:
+                noise_block = noise * lif.noise_rng.standard_normal(
+                    (n_block, n_batch, n_nodes), dtype=dtype)
+            else:
+                noise_block = no_noise
+            stim_mask = schedule.masks(lif.stim_rng, block, n_block)
+
+            indices, steps = kernel(
+                block, lif.v, lif.IPSC, lif.h, lif.r, lif.hr, lif.refractory,
+                *w, ext_stim, noise_block, stim_mask, stim_ptr, schedule.ptr,
+                schedule.units, schedule.amplitude, rs, spike_counts,
+                *recordings, dec,
+                dt=dt, decay_td=decay_td, decay_tr=decay_tr, td=td,
+                tr_td=tr_td, tr=tr, **params)
+            spikes.append(indices, steps)
+
+    def _parse_stim(self, stim, stim_mode, stim_dur, stim_units, stim_val):
+        """
+        Returns the list of stimulation protocols given by the arguments
+        stim, stim_mode, stim_dur, stim_units and stim_val of self.simulate
+        """
+        if stim is None:
+            stims = []
+        elif isinstance(stim, Stimulation):
+            stims = [stim]
+        else:
+            stims = list(stim)
+            if not all(isinstance(s, Stimulation) for s in stims):
+                raise TypeError('stim must be Stimulation or list of '
+                                'Stimulation')
+
+        if stim_mode is not None:
+            stims.append(Stimulation.from_stim_mode(
+                stim_mode, stim_dur, stim_units, stim_val))
+
+        return stims
+
+    def _parse_record(self, record):
+        """
+        Returns the decimation factor of each requested recording (see
+        self.simulate)
+        """
+        if record is None:
+            return {}
+        if isinstance(record, str):
+            if record != 'all':
+                raise ValueError("record must be 'all', list or dict")
+            record = SNN_RECORDINGS
+        if not isinstance(record, dict):
+            record = {name: 1 for name in record}
+
+        for name, k in record.items():
+            if name not in SNN_RECORDINGS:
+                raise ValueError(f"recording '{name}' not in "
+                                 f"{SNN_RECORDINGS}")
+            if not (isinstance(k, (int, np.integer)) and k >= 1):
+                raise ValueError('decimation factors must be positive '
+                                 'integers')
+
+        return dict(record)
+
     def simulate(
         self, ext_input, w_in,
         downsample = 1, taus = 35,
@@ -433,7 +2210,8 @@ class SpikingNeuralNetwork(Reservoir):
         vreset = -65, vpeak = -40, tr = 2,
         stim_mode = None, stim_dur = None, stim_units = None, stim_val = 0.5,
         input_gain=None, ic=None, output_nodes=None,
-        return_states=True
+        return_states=True, record='all', noise=0.1, stim=None,
+        chunk_size=None, checkpoint=None
     ):
         """
         Simulates the dynamics of a spiking neural network given
@@ -513,6 +2291,10 @@ class SpikingNeuralNetwork(Reservoir):
             depolarizing ('exc') or hyperpolarizing ('inh')
             stimulation (modelling optogenetic stimulation).
             Default: None
+            Note: stim_mode, stim_dur, stim_units and stim_val describe a
+            single stimulation protocol applied with probability 0.5 at
+            every time step (see Stimulation.from_stim_mode); use 'stim'
+            for other or concurrent protocols
         stim_dur : (2,) numpy.ndarray, optional
             Time interval (in timesteps) during which
             artificial stimulation or inhibition is applied.
@@ -537,6 +2319,39 @@ class SpikingNeuralNetwork(Reservoir):
         return_states : bool, optional
             If True, simulated reservoir states are returned.
             Default: True
+        record : 'all', list or dict, optional
+            Recordings {'REC', 'Is', 'IPSCs', 'hs'} that are kept (see
+            class attributes). If dict, it maps each recording to a
+            decimation factor k, such that only every k-th time step is
+            kept. If list, all time steps of the listed recordings are kept.
+            Recordings that are not requested are not allocated and set to
+            None; use record=None to only keep the reservoir states, whose
+            average over every 'timescale' time steps is accumulated while
+            simulating, and the spikes (see self.spikes).
+            Default: 'all'
+        noise : float, optional
+            Standard deviation of the Gaussian noise added to the membrane
+            voltage at every time step (in mV). The noise is drawn from
+            self.rng in blocks of NOISE_BLOCK_SIZE random numbers. If 0 or
+            None, no noise is added.
+            Default: 0.1
+        stim : Stimulation or list of Stimulation, optional
+            Stimulation protocols applied concurrently (in addition to the
+            one given by stim_mode, if any). The protocols are compiled
+            once into the stimulated neurons of each protocol and Bernoulli
+            masks drawn from self.rng in blocks of time steps.
+            Default: None
+        chunk_size : int, optional
+            Number of external time steps (after downsampling) simulated
+            per segment. The results do not depend on chunk_size.
+            Default: None, i.e., a single segment
+        checkpoint : str, optional
+            Directory in which the outputs of each segment and the state of
+            the neurons after the last segment (see self.state) are saved.
+            If the directory already holds a state of the same simulation,
+            e.g., because a previous call was interrupted, the completed
+            segments are loaded and the simulation resumes from that state.
+            Default: None
 
         Returns
         -------
@@ -546,10 +2361,6 @@ class SpikingNeuralNetwork(Reservoir):
             number of output_nodes
         """
 
-        # inhibitory and excitatory neuron indices
-        inh_ind = np.where(self.inh)[0]
-        exc_ind = np.where(self.exc)[0]
-
         # if ext_input is list or tuple convert to numpy.ndarray
         if isinstance(ext_input, (list, tuple)):
             sections = utils.get_sections(ext_input)
@@ -558,6 +2369,208 @@ class SpikingNeuralNetwork(Reservoir):
         else:
             convert_to_list = False
 
+        ext_stim, td, v, random_init = self._init_replica(
+            ext_input, w_in, downsample=downsample, taus=taus,
+            tau_min=tau_min, tau_max=tau_max, sig_param=sig_param,
+            input_gain=input_gain, ic=ic, vreset=vreset)
+
+        results = self._run(
+            ext_stim[np.newaxis], [td], v[np.newaxis],
+            [self._parse_stim(stim, stim_mode, stim_dur, stim_units,
+                              stim_val)],
+            downsample=downsample, timescale=timescale, dt=dt, tref=tref,
+            tm=tm, vreset=vreset, vpeak=vpeak, tr=tr, record=record,
+            noise=noise, chunk_size=chunk_size, checkpoint=checkpoint,
+            random_init=[random_init])
+
+        self._state = results['rs'][0]
+
+        # Convert back to list or tuple
+        if convert_to_list:
+            self._state = utils.split(self._state, sections)
+
+        self.dt = results['dt']
+        self.T = results['T']
+        self.nt = results['nt']
+        # time constants drawn from self.rng may be restored from checkpoint
+        self.td = results['td'][0] if random_init[0] else td
+        for name in SNN_RECORDINGS:
+            rec = results[name]
+            setattr(self, name, None if rec is None else rec[0])
+        self.spikes = results['spikes'][0]
+        self.spike_counts = results['spike_counts'][0]
+        self.timescale = timescale
+        # first external time step of each trial (after downsampling)
+        self._trials = -(-np.append(0, sections) // downsample) \
+            if convert_to_list else None
+        self.rs = results['rs'][0].T
+        self.inh_fr = results['inh_fr'][0]
+        self.exc_fr = results['exc_fr'][0]
+        self.all_fr = results['all_fr'][0]
+
+        # Return the same type
+        if return_states:
+            if output_nodes is not None:
+                if convert_to_list:
+                    return [state[:, output_nodes] for state in self._state]
+                else:
+                    return self._state[:, output_nodes]
+            else:
+                return self._state
+
+    def simulate_batch(
+        self, ext_input, w_in, replicas=None, downsample=1, timescale=100,
+        dt=0.05, tref=2, tm=10, vreset=-65, vpeak=-40, tr=2,
+        output_nodes=None, return_states=True, record='all', noise=0.1,
+        chunk_size=None, checkpoint=None, **kwargs
+    ):
+        """
+        Simulates B independent replicas of the spiking neural network in a
+        single time loop, e.g., to sweep over 'taus', 'sig_param' or
+        'input_gain', or to simulate independent trials at once. The
+        replicas share the connectivity matrix and the parameters of the
+        LIF neurons, but each replica has its own external input, synaptic
+        decay time constants, initial voltages and stimulation.
+
+        Parameters
+        ----------
+        ext_input : (B, time, N_inputs) numpy.ndarray or list of B (time, N_inputs) numpy.ndarray
+            External input signal of each replica. A single
+            (time, N_inputs) numpy.ndarray is shared by all replicas.
+            Replicas may have different numbers of time steps (e.g.,
+            independent trials of different durations): their inputs are
+            padded with zeros to the longest replica, such that all
+            replicas are advanced in lockstep, and their outputs are
+            trimmed to their own time steps afterwards (the padded time
+            steps are still simulated).
+            N_inputs: number of external input signals
+        w_in : (N_inputs, N) numpy.ndarray
+            Input connectivity matrix (source, target)
+            N_inputs: number of external input signals
+            N: number of nodes in the network
+        replicas : list of dict, optional
+            Keyword arguments of self.simulate of each replica, among
+            SNN_REPLICA_PARAMS ('taus', 'tau_min', 'tau_max', 'sig_param',
+            'input_gain', 'ic', 'stim_mode', 'stim_dur', 'stim_units',
+            'stim_val', 'stim'). Default: None, i.e., one replica per
+            external input signal
+        kwargs :
+            Keyword arguments of self.simulate among SNN_REPLICA_PARAMS
+            shared by all replicas (overridden by 'replicas')
+
+        The remaining parameters are the same as in self.simulate.
+
+        Returns
+        -------
+        self._state : (B, time, N) numpy.ndarray or list of B (time, N) numpy.ndarray
+            Activation states of each replica (a list if the replicas have
+            different numbers of time steps).
+            B: number of replicas
+            N: number of nodes in the network if output_nodes is None, else
+            number of output_nodes
+
+        Notes
+        -----
+        The attributes set by self.simulate gain a leading replica axis,
+        i.e., td, rs, REC, Is, IPSCs, hs, spike_counts, inh_fr, exc_fr and
+        all_fr are (B, ...) numpy.ndarray, and spikes is a list of B
+        SpikeRaster. If the replicas have different numbers of time steps,
+        then rs, REC, Is, IPSCs, hs and spike_counts are lists of B
+        numpy.ndarray, and T and nt are (B,) numpy.ndarray.
+        The replicas draw their random numbers from self.rng one after the
+        other, such that a batch of a single replica reproduces
+        self.simulate given the same seed.
+        """
+
+        for name in kwargs:
+            if name not in SNN_REPLICA_PARAMS:
+                raise TypeError(f"simulate_batch() got an unexpected keyword "
+                                f"argument '{name}'")
+
+        if isinstance(ext_input, np.ndarray) and ext_input.ndim == 2:
+            if replicas is None:
+                raise ValueError('replicas must be specified if ext_input is '
+                                 'shared by all replicas')
+            ext_input = [ext_input] * len(replicas)
+        if replicas is None:
+            replicas = [{}] * len(ext_input)
+        if len(ext_input) != len(replicas):
+            raise ValueError('ext_input and replicas must have the same '
+                             'number of replicas')
+
+        # default keyword arguments of self.simulate
+        defaults = inspect.signature(self.simulate).parameters
+        ext_stim, td, v, stims, random_init = [], [], [], [], []
+        for x, replica in zip(ext_input, replicas):
+            for name in replica:
+                if name not in SNN_REPLICA_PARAMS:
+                    raise ValueError(f"replica parameter '{name}' not in "
+                                     f"{SNN_REPLICA_PARAMS}")
+            params = {name: defaults[name].default
+                      for name in SNN_REPLICA_PARAMS}
+            params.update(kwargs, **replica)
+
+            stim, td_b, v_b, random_b = self._init_replica(
+                x, w_in, downsample=downsample, taus=params['taus'],
+                tau_min=params['tau_min'], tau_max=params['tau_max'],
+                sig_param=params['sig_param'],
+                input_gain=params['input_gain'], ic=params['ic'],
+                vreset=vreset)
+            ext_stim.append(stim)
+            td.append(td_b)
+            v.append(v_b)
+            random_init.append(random_b)
+            stims.append(self._parse_stim(
+                params['stim'], params['stim_mode'], params['stim_dur'],
+                params['stim_units'], params['stim_val']))
+
+        # inputs of the replicas padded to the longest one
+        lengths = np.array([stim.shape[1] for stim in ext_stim])
+        ext_stim = np.stack([np.pad(stim, ((0, 0), (0, lengths.max() - n)))
+                             for stim, n in zip(ext_stim, lengths)])
+
+        results = self._run(
+            ext_stim, td, np.stack(v), stims, lengths=lengths,
+            downsample=downsample, timescale=timescale, dt=dt, tref=tref,
+            tm=tm, vreset=vreset, vpeak=vpeak, tr=tr, record=record,
+            noise=noise, chunk_size=chunk_size, checkpoint=checkpoint,
+            random_init=random_init)
+
+        self._state = results['rs']
+        self.dt = results['dt']
+        self.T = results['T']
+        self.nt = results['nt']
+        self.td = results['td']
+        for name in SNN_RECORDINGS:
+            setattr(self, name, results[name])
+        self.spikes = results['spikes']
+        self.spike_counts = results['spike_counts']
+        self.timescale = timescale
+        self._trials = None
+        if isinstance(results['rs'], list):
+            self.rs = [rs.T for rs in results['rs']]
+        else:
+            self.rs = results['rs'].transpose(0, 2, 1)
+        self.inh_fr = results['inh_fr']
+        self.exc_fr = results['exc_fr']
+        self.all_fr = results['all_fr']
+
+        if return_states:
+            if output_nodes is not None:
+                if isinstance(self._state, list):
+                    return [state[:, output_nodes] for state in self._state]
+                return self._state[:, :, output_nodes]
+            else:
+                return self._state
+
+    def _init_replica(self, ext_input, w_in, downsample, taus, tau_min,
+                      tau_max, sig_param, input_gain, ic, vreset):
+        """
+        Returns the external input current (N, time), the synaptic decay
+        time constants (in s) and the initial voltages (N,) of a replica
+        given the corresponding arguments of self.simulate, and whether the
+        time constants and the voltages were drawn from self.rng
+        """
         # scale input connectivity matrix
         if input_gain is not None:
             w_in = input_gain * w_in
@@ -566,15 +2579,87 @@ class SpikingNeuralNetwork(Reservoir):
         # Downsample input stimulus
         ext_input = ext_input.T
         ext_input = ext_input[:, ::downsample]
-        ext_stim = np.dot(w_in, ext_input)
+        ext_stim = np.dot(w_in, ext_input).astype(self.dtype, copy=False)
+
+        # Synaptic decay time constants (in sec)
+        # for the synaptic filter
+        # td: decay time constants
+        random_td = isinstance(sig_param, str) and sig_param == 'normal'
+        if sig_param is not None:
+            if random_td:
+                sig_param = self.rng.standard_normal(self.n_nodes)
+            td = (1 / (1 + np.exp(-sig_param)) * (tau_max - tau_min)
+                  + tau_min) / 1000
+        else:
+            td = taus/1000
+        td = np.asarray(td, dtype=self.dtype)
+
+        # Initialize voltage
+        if ic is not None:
+            v = np.asarray(ic, dtype=self.dtype)
+        else:
+            v = (vreset + self.rng.random(self.n_nodes) * (30 - vreset)
+                 ).astype(self.dtype)
+
+        return ext_stim, td, v, (random_td, ic is None)
+
+    def _run(self, ext_stim, td, v, stims, downsample, timescale, dt, tref,
+             tm, vreset, vpeak, tr, record, noise, chunk_size=None,
+             checkpoint=None, random_init=None, lengths=None):
+        """
+        Runs the time loop of B independent replicas of the network
+
+        Parameters
+        ----------
+        ext_stim : (B, N, time) numpy.ndarray
+            External input current of each replica (one column per
+            external time step, after downsampling)
+        td : list of B float or (N,) numpy.ndarray
+            Synaptic decay time constants of each replica (in s)
+        v : (B, N) numpy.ndarray
+            Initial voltages of each replica
+        stims : list of B list of Stimulation
+            Stimulation protocols of each replica
+        random_init : (B, 2) array_like of bool, optional
+            Whether td and v of each replica were drawn from self.rng, in
+            which case they are restored from 'checkpoint' when resuming
+            rather than compared with it. Default: None, i.e., neither
+        lengths : (B,) array_like of int, optional
+            Number of external time steps of each replica, whose input is
+            padded with zeros to the length of ext_stim. The outputs of the
+            padded time steps are discarded. Default: None, i.e., all
+            replicas span all time steps of ext_stim
+        The remaining parameters are the same as in self.simulate.
+
+        Returns
+        -------
+        results : dict
+            'rs', 'REC', 'Is', 'IPSCs', 'hs', 'spike_counts', 'inh_fr',
+            'exc_fr' and 'all_fr' with a leading replica axis (recordings
+            that are not requested are None), 'spikes' (list of B
+            SpikeRaster), 'td' (B, N) and 'dt', 'T', 'nt'. If the replicas
+            have different lengths, then 'rs', 'spike_counts' and the
+            recordings are lists of B numpy.ndarray, and 'T' and 'nt' are
+            (B,) numpy.ndarray
+        """
+        n_batch, n_nodes = v.shape
+
+        # inhibitory and excitatory neuron indices
+        inh_ind = np.where(self.inh)[0]
+        exc_ind = np.where(self.exc)[0]
 
         # Set simulation parameters
         # sampling rate (s)
         dt = dt/1000 * downsample
         # trial duration (s)
-        T = (ext_input.shape[1]) * dt * timescale
+        T = (ext_stim.shape[2]) * dt * timescale
         # number of time steps
         nt = int(np.round(T / dt))
+        # number of external time steps of each replica
+        if lengths is None:
+            lengths = np.full(n_batch, ext_stim.shape[2])
+        lengths = np.asarray(lengths, dtype=np.int64)
+        variable = np.any(lengths != ext_stim.shape[2])
         # refractory time constant (s)
         tref = tref/1000
         # membrane time constant (s)
@@ -582,177 +2667,388 @@ class SpikingNeuralNetwork(Reservoir):
         # rise time constant (s)
         tr = tr/1000
 
-        # Synaptic decay time constants (in sec)
-        # for the synaptic filter
-        # td: decay time constants
-        if sig_param is not None:
-            if sig_param == 'normal':
-                sig_param = np.random.randn(self.n_nodes)
-            td = (1 / (1 + np.exp(-sig_param)) * (tau_max - tau_min)
-                  + tau_min) / 1000
-        else:
-            td = taus/1000
-
         # Initialize variables for LIF neurons simulation
-        # post synaptic current
-        IPSC = np.zeros(self.n_nodes)
-        # filtered firing rates (synaptic input accumulation)
-        h = np.zeros(self.n_nodes)
-        # filtered firing rates
-        r = np.zeros(self.n_nodes)
-        # filtered firing rates (rising phase)
-        hr = np.zeros(self.n_nodes)
-        # contribution of each neuron to IPSC
-        JD = np.zeros(self.n_nodes)
-        # number of spikes
-        ns = 0
-
-        # Initialize voltage
-        if ic is not None:
-            v = ic
+        dtype = self.dtype
+        td = np.stack([np.broadcast_to(td_b, n_nodes) for td_b in td])
+        # number of time steps during which the voltage is frozen after a
+        # spike (the refractory period tref, up to rounding errors)
+        n_ref = int(np.floor(np.round(tref / dt, 6)))
+        # the time steps are simulated in segments of 'chunk_size' external
+        # time steps, whose outputs and final state are persisted in the
+        # 'checkpoint' directory
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer')
+        seg_steps = nt if chunk_size is None else chunk_size * timescale
+        dec = self._parse_record(record)
+        schedule = _StimulationSchedule(stims, n_nodes, dtype=dtype)
+        if checkpoint is not None:
+            os.makedirs(checkpoint, exist_ok=True)
+            meta_file = os.path.join(checkpoint, 'checkpoint.npz')
+            state_file = os.path.join(checkpoint, 'state.npz')
+            # the input current, connectivity, stimulation and parameters
+            # of the simulation (the decay time constants and initial
+            # voltages drawn from self.rng are restored from the checkpoint
+            # instead)
+            if random_init is None:
+                random_init = np.zeros((n_batch, 2), dtype=bool)
+            random_td, random_v = np.asarray(random_init, dtype=bool).T
+            if sp.issparse(self.w):
+                w = [self.w.data, self.w.indices, self.w.indptr]
+            else:
+                w = [self.w]
+            fingerprint = _fingerprint(
+                ext_stim, lengths, *w, random_td, random_v,
+                np.where(random_td[:, np.newaxis], 0, td),
+                np.where(random_v[:, np.newaxis], 0, v),
+                schedule.replica, schedule.onset,
+                schedule.offset, schedule.amplitude, schedule.probability,
+                schedule.ptr, schedule.units,
+                [dt, tref, tm, vreset, vpeak, tr, noise or 0, timescale,
+                 n_ref] + [dec.get(name, 0) for name in SNN_RECORDINGS])
+        if checkpoint is not None and os.path.exists(state_file):
+            # resume from the last segment of the checkpoint
+            with np.load(meta_file) as meta:
+                if int(meta['nt']) != nt \
+                        or int(meta['seg_steps']) != seg_steps \
+                        or meta['td'].shape != td.shape \
+                        or str(meta['fingerprint']) != fingerprint:
+                    raise ValueError('checkpoint does not match the '
+                                     'simulation')
+                td = np.where(random_td[:, np.newaxis], meta['td'],
+                              td).astype(dtype)
+                self.rng.bit_generator.state = json.loads(str(meta['rng']))
+            self._lif = LIFState.load(state_file)
+            if self._lif.dtype != dtype:
+                raise ValueError('checkpoint does not match the simulation')
         else:
-            v = vreset + np.random.rand(self.n_nodes) * (30 - vreset)
-
-        # Initialize storage arrays for recording results
+            # state of the neurons, whose arrays are reused by consecutive
+            # simulations of the same shape. As in the original model,
+            # neurons start out refractory, as if they had spiked just
+            # before the first time step. Noise and stimulation coin flips
+            # are drawn from separate streams.
+            if self._lif is None or self._lif.shape != (n_batch, n_nodes) \
+                    or self._lif.dtype != dtype:
+                self._lif = LIFState(n_batch, n_nodes, dtype=dtype)
+            self._lif.reset(v, n_ref + 1, *[
+                np.random.default_rng(seed)
+                for seed in self.rng.integers(2 ** 63, size=2)])
+            if checkpoint is not None:
+                np.savez(meta_file, nt=nt, seg_steps=seg_steps, td=td,
+                         fingerprint=fingerprint, rng=_rng_state(self.rng))
+        lif = self._lif
+        v, IPSC, h, r, hr = lif.v, lif.IPSC, lif.h, lif.r, lif.hr
+        refractory, spiking = lif.refractory, lif.spiking
+        JD, tmp = lif.JD, lif.tmp
+        # Synaptic filter (updated in place), chosen once with its decay
+        # factors, which are constant throughout the simulation. If the
+        # rise time is 0, then use the single synaptic filter (h and hr
+        # remain 0), otherwise (i.e. if the rise time is positive) use the
+        # double-exponential filter. Contributions of the spiking neurons
+        # (JD and spiking) are only added on time steps with spikes.
+        decay_td = np.exp(-dt / td)
+        if tr == 0:
+            def synaptic_filter(has_spikes):
+                np.multiply(IPSC, decay_td, out=IPSC)
+                np.multiply(r, decay_td, out=r)
+                if has_spikes:
+                    np.add(IPSC, np.divide(JD, td, out=tmp), out=IPSC)
+                    np.add(r, np.divide(spiking, td, out=tmp), out=r)
+        else:
+            decay_tr = np.exp(-dt / tr)
+            tr_td = tr * td
+
+            def synaptic_filter(has_spikes):
+                np.multiply(IPSC, decay_td, out=IPSC)
+                np.add(IPSC, np.multiply(h, dt, out=tmp), out=IPSC)
+                np.multiply(h, decay_tr, out=h)
+                np.multiply(r, decay_td, out=r)
+                np.add(r, np.multiply(hr, dt, out=tmp), out=r)
+                np.multiply(hr, decay_tr, out=hr)
+                if has_spikes:
+                    np.add(h, np.divide(JD, tr_td, out=tmp), out=h)
+                    np.add(hr, np.divide(spiking, tr_td, out=tmp), out=hr)
+        # weighted contributions of the spiking neurons 'index' of the
+        # replicas 'batch' to IPSC (written into JD), i.e., the sum of their
+        # outgoing weights (columns of w)
+        if sp.issparse(self.w):
+            indptr, indices, data = self.w.indptr, self.w.indices, self.w.data
+            fan_out = np.diff(indptr)
+
+            def synaptic_input(batch, index):
+                # positions in 'indices' and 'data' of the outgoing weights
+                # of the spiking neurons
+                starts, counts = indptr[index], fan_out[index]
+                pos = np.arange(counts.sum()) + np.repeat(
+                    starts - np.cumsum(counts) + counts, counts)
+                targets = indices[pos] + n_nodes * np.repeat(batch, counts)
+                JD[:] = np.bincount(
+                    targets, weights=data[pos], minlength=n_batch * n_nodes
+                ).reshape(n_batch, n_nodes)
+        else:
+            def synaptic_input(batch, index):
+                # spikes are ordered by replica
+                bounds = np.searchsorted(batch, np.arange(n_batch + 1))
+                JD.fill(0)
+                for b in range(n_batch):
+                    if bounds[b] < bounds[b + 1]:
+                        np.sum(self.w[:, index[bounds[b]:bounds[b + 1]]],
+                               axis=1, out=JD[b])
+
+        # spike events (flat indices b * N + neuron and time steps)
+        spikes = _SpikeBuffer()
+
+        # Initialize storage arrays for the requested recordings, which
+        # keep every k-th time step (k: decimation factor)
+        n_rec = {name: -(-nt // k) for name, k in dec.items()}
         # membrane voltage tracings (mV)
-        REC = np.zeros((nt, self.n_nodes))
+        REC = np.zeros((n_batch, n_rec['REC'], n_nodes), dtype=dtype) \
+            if 'REC' in dec else None
         # external input current
-        Is = np.zeros((self.n_nodes, nt))
+        Is = np.zeros((n_batch, n_nodes, n_rec['Is']), dtype=dtype) \
+            if 'Is' in dec else None
         # post synaptic currents over time
-        IPSCs = np.zeros((self.n_nodes, nt))
-        # spike raster
-        spk = np.zeros((self.n_nodes, nt))
-        # filtered firing rates over time
-        rs = np.zeros((self.n_nodes, nt))
+        IPSCs = np.zeros((n_batch, n_nodes, n_rec['IPSCs']), dtype=dtype) \
+            if 'IPSCs' in dec else None
         # filtered firing rates over time (synaptic input accumulation)
-        hs = np.zeros((self.n_nodes, nt))
-
-        tlast = np.zeros(self.n_nodes) # last spike time
+        hs = np.zeros((n_batch, n_nodes, n_rec['hs']), dtype=dtype) \
+            if 'hs' in dec else None
+        # filtered firing rates averaged over every 'timescale' time steps
+        # (accumulated while simulating)
+        rs = np.zeros((n_batch, nt // timescale, n_nodes), dtype=dtype)
+        # spike counts of every 'timescale' time steps (accumulated while
+        # simulating)
+        spike_counts = np.zeros((n_batch, nt // timescale, n_nodes),
+                                dtype=np.int32)
 
         BIAS = vpeak # bias current
 
-        # Start the simulation loop
-        for i in range(nt):
-            # Record IPSC over time
-            IPSCs[:, i] = IPSC
-
-            # Calculate synaptic current
-            I = IPSC + BIAS
-            I = I + ext_stim[:, i // timescale]
-            Is[:, i] = ext_stim[:, i // timescale]
-
-            # Compute voltage change according to LIF equation
-            dv = (dt * i > tlast + tref) * (-v + I) / tm
-            v = v + dt * dv + np.random.randn(self.n_nodes) / 10
-
-            # Apply artificial stimulation/inhibition
-            if stim_mode == 'exc':
-                if stim_dur is None:
-                    raise ValueError('stim_dur not specified')
-                elif stim_dur[0] <= i < stim_dur[1]:
-                    if stim_units is None:
-                        raise ValueError('stim_units not specified')
-                    elif np.random.rand() < 0.5:
-                        v[stim_units] = v[stim_units] + stim_val
-            elif stim_mode == 'inh':
-                if stim_dur is None:
-                    raise ValueError('stim_dur not specified')
-                elif stim_dur[0] <= i < stim_dur[1]:
-                    if stim_units is None:
-                        raise ValueError('stim_units not specified')
-                    elif np.random.rand() < 0.5:
-                        v[stim_units] = v[stim_units] - stim_val
-
-            # Indices of neurons that have fired
-            index = np.where(v >= vpeak)[0]
-
-            # Store spike times and compute weighted contributions to IPSC
-            if len(index) > 0:
-                JD = np.sum(self.w[:, index], axis=1)
-                curr_ts = np.column_stack((index, np.zeros(len(index)) + dt * i))
-                if ns == 0:
-                    tspike = curr_ts
-                else:
-                    tspike = np.append(tspike, curr_ts, axis=0)
-                ns = ns + len(index)
-
-            # Set refractory period
-            tlast = tlast + (dt * i - tlast) * (v >= vpeak)
-
-            # Compute IPSC and filtered firing rates
-            # If the rise time is 0, then use the single synaptic filter,
-            # otherwise (i.e. if the rise time is positive)
-            # use the double-exponential filter
-            if tr == 0:
-                IPSC = IPSC * np.exp(-dt / td) + JD * (len(index) > 0) / td
-                r = r * np.exp(-dt / td) + (v >= vpeak) / td
-                rs[:, i] = r
+        # noise and stimulation coin flips are drawn in blocks of time
+        # steps, and do not depend on the size of the blocks
+        block_size = max(1, NOISE_BLOCK_SIZE // (n_batch * n_nodes))
+
+        def integrate(start, stop):
+            # Simulation loop over time steps [start, stop)
+            v, I, dv = lif.v, lif.I, lif.dv
+            for i in range(start, stop):
+                t = (i - start) % block_size
+                if t == 0:
+                    n_block = min(block_size, stop - i)
+                    if noise:
+                        noise_block = noise * lif.noise_rng.standard_normal(
+                            (n_block, n_batch, n_nodes), dtype=dtype)
+                    stim_block = schedule.masks(lif.stim_rng, i, n_block)
+                    stim_steps = stim_block.any(axis=1)
+
+                # Record IPSC over time
+                if IPSCs is not None and i % dec['IPSCs'] == 0:
+                    IPSCs[:, :, i // dec['IPSCs']] = IPSC
+
+                # Calculate synaptic current
+                np.add(IPSC, BIAS, out=I)
+                I += ext_stim[:, :, i // timescale]
+                if Is is not None and i % dec['Is'] == 0:
+                    Is[:, :, i // dec['Is']] = ext_stim[:, :, i // timescale]
+
+                # Compute voltage change according to LIF equation; the
+                # voltage of refractory neurons is frozen while their
+                # countdown runs
+                active = refractory == 0
+                np.subtract(I, v, out=dv)
+                dv *= active
+                dv /= tm
+                dv *= dt
+                v += dv
+                np.subtract(refractory, 1, out=refractory, where=~active)
+                if noise:
+                    v += noise_block[t]
+
+                # Apply artificial stimulation/inhibition
+                if stim_steps[t]:
+                    v += schedule.drive(stim_block[t])
+
+                # Spike mask of the time step, and replicas and indices of
+                # neurons that have fired
+                np.greater_equal(v, vpeak, out=spiking)
+                batch, index = np.nonzero(spiking)
+                has_spikes = len(index) > 0
+
+                # Store spike times, compute weighted contributions to IPSC
+                # and set refractory period
+                if has_spikes:
+                    synaptic_input(batch, index)
+                    spikes.append(batch * n_nodes + index, i)
+                    spike_counts[batch, i // timescale, index] += 1
+                    refractory[spiking] = n_ref
+
+                # Compute IPSC and filtered firing rates
+                synaptic_filter(has_spikes)
+                rs[:, i // timescale] += r
+                if hs is not None and i % dec['hs'] == 0:
+                    hs[:, :, i // dec['hs']] = h
+
+                # Cap depolarization
+                if has_spikes:
+                    v[spiking] = 30
+
+                # Record membrane voltage
+                if REC is not None and i % dec['REC'] == 0:
+                    REC[:, i // dec['REC'], :] = v
+
+                # Reset voltage after spike
+                if has_spikes:
+                    v[spiking] = vreset
+
+        # outputs with their time axis and decimation factor (rs and
+        # spike_counts have one row every 'timescale' time steps)
+        outputs = {'rs': (rs, 1, timescale),
+                   'spike_counts': (spike_counts, 1, timescale)}
+        for name, rec, axis in zip(SNN_RECORDINGS, (REC, Is, IPSCs, hs),
+                                   (1, 2, 2, 2)):
+            if rec is not None:
+                outputs[name] = (rec, axis, dec[name])
+
+        def segment(start, stop):
+            # views of the outputs of time steps [start, stop)
+            views = {}
+            for name, (x, axis, k) in outputs.items():
+                index = [slice(None)] * x.ndim
+                index[axis] = slice(-(-start // k), -(-stop // k))
+                views[name] = x[tuple(index)]
+            return views
+
+        # Start the simulation
+        for n, start in enumerate(range(0, nt, seg_steps)):
+            stop = min(start + seg_steps, nt)
+            if checkpoint is not None:
+                seg_file = os.path.join(checkpoint, f'segment_{n:05d}.npz')
+
+            # segments simulated before resuming from the checkpoint
+            if stop <= lif.step:
+                with np.load(seg_file) as data:
+                    for name, view in segment(start, stop).items():
+                        view[...] = data[name]
+                    spikes.append(data['indices'], data['steps'])
+                continue
+
+            n_spikes = spikes.size
+            if self.backend == 'numba':
+                self._simulate_numba(
+                    start, stop, lif, ext_stim, rs, spike_counts,
+                    (REC, Is, IPSCs, hs), dec, spikes, block_size, noise,
+                    schedule, timescale=timescale, dt=dt, n_ref=n_ref, tm=tm,
+                    bias=BIAS, vreset=vreset, vpeak=vpeak, td=td, tr=tr)
             else:
-                IPSC = IPSC * np.exp(-dt / td) + h * dt
-                h = h * np.exp(-dt / tr) + JD * (len(index) > 0) / (tr * td)
-                hs[:, i] = h
-
-                r = r * np.exp(-dt / td) + hr * dt
-                hr = hr * np.exp(-dt / tr) + (v >= vpeak) / (tr * td)
-                rs[:, i] = r
-
-            # Record spikes
-            spk[:, i] = v >= vpeak
-
-            # Cap depolarization
-            v = v + (30 - v) * (v >= vpeak)
-
-            # Record membrane voltage
-            REC[i, :] = v
-
-            # Reset voltage after spike
-            v = v + (vreset - v) * (v >= vpeak)
-
-        # Compute average firing rates for different populations
-        inh_fr = np.zeros(len(inh_ind))
-        for i in range(len(inh_ind)):
-            inh_fr[i] = np.sum(spk[inh_ind[i], :] > 0) / T
-
-        exc_fr = np.zeros(len(exc_ind))
-        for i in range(len(exc_ind)):
-            exc_fr[i] = np.sum(spk[exc_ind[i], :] > 0) / T
-
-        all_fr = np.zeros(self.n_nodes)
-        for i in range(self.n_nodes):
-            all_fr[i] = np.sum(spk[i, 10:] > 0) / T
+                integrate(start, stop)
+            lif.step = stop
+
+            # persist the outputs of the segment and then the state, which
+            # is replaced atomically such that an interrupted simulation
+            # resumes from the last complete segment
+            if checkpoint is not None:
+                new = slice(n_spikes, spikes.size)
+                np.savez(seg_file, indices=spikes.indices[new],
+                         steps=spikes.steps[new], **segment(start, stop))
+                with open(state_file + '.tmp', 'wb') as f:
+                    lif.save(f)
+                os.replace(state_file + '.tmp', state_file)
+
+        # number of time steps and duration of each replica
+        nt_b = lengths * timescale if variable else np.full(n_batch, nt)
+        T_b = lengths * dt * timescale
+
+        # Spike raster of each replica (up to its last time step)
+        indices, steps = spikes.finalize()
+        batch, indices = np.divmod(indices, n_nodes)
+        spikes = []
+        for b in range(n_batch):
+            keep = (batch == b) & (steps < nt_b[b])
+            spikes.append(SpikeRaster.from_events(
+                indices[keep], steps[keep], n_nodes, nt_b[b], dt))
+
+        # Compute average firing rates for different populations from the
+        # spike counts (all_fr excludes the first 10 time steps, whose
+        # spikes are read from the spike raster)
+        counts = np.stack([spike_counts[b, :n].sum(axis=0)
+                           for b, n in enumerate(lengths)])
+        inh_fr = counts[:, inh_ind] / T_b[:, np.newaxis]
+        exc_fr = counts[:, exc_ind] / T_b[:, np.newaxis]
+        all_fr = (counts - np.stack([raster.counts(stop=10)
+                                     for raster in spikes])) \
+            / T_b[:, np.newaxis]
 
         # Average over every 'timescale' time steps
-        rs = rs.reshape(rs.shape[0], int(rs.shape[1]/timescale), timescale).mean(axis = -1)
-        self._state = rs.T
-
-        # Convert back to list or tuple
-        if convert_to_list:
-            self._state = utils.split(self._state, sections)
-
-        self.dt = dt
-        self.T = T
-        self.nt = nt
-        self.td = td
-        self.REC = REC
-        self.Is = Is
-        self.IPSCs = IPSCs
-        self.spk = spk
-        self.rs = rs
-        self.hs = hs
-        self.tspike = tspike
-        self.inh_fr = inh_fr
-        self.exc_fr = exc_fr
-        self.all_fr = all_fr
+        rs /= timescale
+
+        # Trim the outputs of each replica to its own time steps
+        if variable:
+            T, nt = T_b, nt_b
+            rs = [rs[b, :n] for b, n in enumerate(lengths)]
+            spike_counts = [spike_counts[b, :n]
+                            for b, n in enumerate(lengths)]
+            REC = None if REC is None else [
+                REC[b, :-(-n // dec['REC'])] for b, n in enumerate(nt_b)]
+            Is, IPSCs, hs = [
+                None if rec is None else [
+                    rec[b, :, :-(-n // dec[name])]
+                    for b, n in enumerate(nt_b)]
+                for name, rec in zip(SNN_RECORDINGS[1:], (Is, IPSCs, hs))]
+
+        return dict(rs=rs, REC=REC, Is=Is, IPSCs=IPSCs, hs=hs, spikes=spikes,
+                    spike_counts=spike_counts, inh_fr=inh_fr, exc_fr=exc_fr,
+                    all_fr=all_fr, td=td, dt=dt, T=T, nt=nt)
+
+
+def _solve_laplacian(A, b):
+    """
+    Solves the linear system A x = b, where A is a block of a weighted
+    graph Laplacian (symmetric positive semi-definite), e.g., the block of
+    the internal nodes of a memristive network
+
+    The system is solved with a Cholesky factorization if A is a
+    numpy.ndarray, or with the conjugate gradient method if A is a
+    scipy.sparse matrix. If A is singular (e.g., if some internal nodes are
+    not connected to any external or grounded node), which is detected from
+    the pivots of the factorization or the convergence of the conjugate
+    gradient method, then the minimum norm least squares solution is
+    returned instead, as with the pseudo-inverse of A.
+
+    Parameters
+    ----------
+    A : (N, N) numpy.ndarray or scipy.sparse matrix
+        Symmetric positive (semi-)definite matrix
+    b : (N,) numpy.ndarray
+        Right-hand side
 
-        # Return the same type
-        if return_states:
-            if output_nodes is not None:
-                if convert_to_list:
-                    return [state[:, output_nodes] for state in self._state]
-                else:
-                    return self._state[:, output_nodes]
-            else:
-                return self._state
+    Returns
+    -------
+    x : (N,) numpy.ndarray
+        Solution of the linear system
+    """
+    if sp.issparse(A):
+        # the relative tolerance of cg is called 'tol' before SciPy 1.12
+        if 'rtol' in inspect.signature(sp_sparse_linalg.cg).parameters:
+            tol = {'rtol': 1e-10}
+        else:
+            tol = {'tol': 1e-10}
+        # the iterations may diverge if A is singular
+        with np.errstate(over='ignore', invalid='ignore'):
+            x, info = sp_sparse_linalg.cg(A, b, atol=0, **tol)
+        if info == 0:
+            return x
+        return sp_sparse_linalg.lsqr(A, b, atol=1e-12, btol=1e-12)[0]
+
+    # the factorization of a singular matrix often succeeds with a pivot
+    # that rounds to a tiny positive value, hence the pivots are checked
+    try:
+        factor = sp_linalg.cho_factor(A, check_finite=False)
+        pivots = np.abs(np.diag(factor[0]))
+        singular = pivots.min() <= np.sqrt(np.finfo(pivots.dtype).eps) \
+            * pivots.max()
+    except sp_linalg.LinAlgError:
+        singular = True
+    if singular:
+        return sp_linalg.lstsq(A, b)[0]
+    return sp_linalg.cho_solve(factor, b, check_finite=False)
 
 
 class MemristiveReservoir:
@@ -913,11 +3209,19 @@ class MemristiveReservoir:
         Parameters
         ----------
         # TODO
+        G : (N, N) numpy.ndarray or scipy.sparse matrix, optional
+            Conductance matrix, by default self._G
 
         Returns
         -------
         # TODO
 
+        Notes
+        -----
+        The block A_II of the internal nodes of the graph Laplacian
+        A = N - G (N: diagonal matrix of the node degrees) is symmetric
+        positive semi-definite, hence the voltages are solved with
+        _solve_laplacian rather than by inverting A_II.
         """
 
         if Vgr is None:
@@ -926,26 +3230,26 @@ class MemristiveReservoir:
             G = self._G
 
         # TODO: verify that the axis along which the sum is performed is correct
-        # matrix N
-        N = np.zeros((self._n_nodes, self._n_nodes))
-        np.fill_diagonal(N, np.sum(G, axis=1))
-
-        # matrix A
-        A = N - G
-
-        # inverse matrix A_II
-        A_II = A[np.ix_(self._I, self._I)]
-        # print(matrix_rank(A_II, hermitian=utils.check_symmetric(A_II)))
-        A_II_inv = pinv(A_II)
-
-        # matrix HI
-        H_IE = np.dot(G[np.ix_(self._I, self._E)], Ve)
-        H_IGR = np.dot(G[np.ix_(self._I, self._GR)], Vgr)
+        # degrees of the internal nodes (diagonal of matrix N)
+        if sp.issparse(G):
+            G = sp.csr_matrix(G)
+            degree = np.asarray(G[self._I].sum(axis=1)).ravel()
+            G_I = G[self._I]
+            A_II = sp.diags(degree) - G_I[:, self._I]
+            H_I = G_I[:, self._E] @ Ve + G_I[:, self._GR] @ Vgr
+        else:
+            degree = np.sum(G[self._I], axis=1)
+            # block A_II of matrix A = N - G
+            A_II = -G[np.ix_(self._I, self._I)]
+            A_II[np.diag_indices_from(A_II)] += degree
 
-        H_I = H_IE + H_IGR
+            # matrix HI
+            H_IE = np.dot(G[np.ix_(self._I, self._E)], Ve)
+            H_IGR = np.dot(G[np.ix_(self._I, self._GR)], Vgr)
+            H_I = H_IE + H_IGR
 
         # return voltage at internal nodes
-        return np.dot(A_II_inv, H_I)
+        return _solve_laplacian(A_II, H_I)
 
     def getV(self, Vi, Ve, Vgr=None):
         """
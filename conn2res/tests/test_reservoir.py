@@ -3,3 +3,925 @@
 For testing conn2res.reservoir functionality
 """
 
+import numpy as np
+import pytest
+from scipy import sparse
+
+from conn2res import reservoir
+from conn2res.reservoir import (EchoStateNetwork, EchoStateNetworkEnsemble,
+                                LinearEchoStateNetwork, SpikingNeuralNetwork,
+                                MemristiveReservoir)
+from conn2res.readout import Readout, train_test_split, select_model
+
+
+def create_test_reservoir(n_nodes=50, n_inputs=2, n_timesteps=200, seed=0):
+    """
+    Create random connectivity, input connectivity and input signal for
+    testing reservoir simulations
+
+    Parameters
+    ----------
+    n_nodes : int, optional
+        number of nodes in the reservoir, by default 50
+    n_inputs : int, optional
+        number of external input signals, by default 2
+    n_timesteps : int, optional
+        number of time steps of the input signal, by default 200
+    seed : int, optional
+        seed to initialize the random number generator, by default 0
+
+    Returns
+    -------
+    w, w_in, x : numpy.ndarray
+        reservoir connectivity matrix normalized by its spectral radius,
+        input connectivity matrix and external input signal
+    """
+    rng = np.random.default_rng(seed=seed)
+    w = rng.uniform(size=(n_nodes, n_nodes)) * \
+        (rng.uniform(size=(n_nodes, n_nodes)) < 0.1)
+    np.fill_diagonal(w, 0)
+    w = w / np.abs(np.linalg.eigvals(w)).max()
+    w_in = rng.uniform(-1, 1, size=(n_inputs, n_nodes))
+    x = rng.uniform(-1, 1, size=(n_timesteps, n_inputs))
+    return w, w_in, x
+
+
+class TestEchoStateNetwork():
+
+    def test_simulate_alpha_batch(self):
+        """
+        Test that simulating a vector of spectral scalings at once matches
+        simulating each scaled reservoir separately
+        """
+        w, w_in, x = create_test_reservoir()
+        alphas = np.linspace(0.2, 1.4, 4)
+        output_nodes = np.arange(10)
+
+        esn = EchoStateNetwork(w=w, activation_function='tanh')
+        rs_batch = esn.simulate(x, w_in, alphas=alphas,
+                                output_nodes=output_nodes)
+
+        assert rs_batch.shape == (len(alphas), len(x), len(output_nodes)), \
+            "incorrect shape of batched states"
+        for alpha, rs in zip(alphas, rs_batch):
+            esn.w = alpha * w
+            assert np.allclose(
+                rs, esn.simulate(x, w_in, output_nodes=output_nodes)
+            ), "batched states differ from single reservoir states"
+
+        # 'alpha' is still passed on to the activation function
+        esn = EchoStateNetwork(w=w, activation_function='leaky_relu')
+        assert np.allclose(
+            esn.simulate(x, w_in, alphas=[1.0], alpha=0.1)[0],
+            esn.simulate(x, w_in, alpha=0.1)
+        ), "alpha is not passed to the activation function"
+
+        # list of trials are returned as one list per alpha
+        esn.w = w
+        rs_list = esn.simulate([x[:120], x[120:]], w_in, alphas=alphas)
+        assert len(rs_list) == len(alphas)
+        assert [len(rs) for rs in rs_list[0]] == [120, 80]
+
+    def test_simulate_sparse(self):
+        """
+        Test that the sparse connectivity backend matches the dense one
+        """
+        w, w_in, x = create_test_reservoir()
+
+        esn_dense = EchoStateNetwork(w=w, activation_function='tanh')
+        esn_sparse = EchoStateNetwork(w=w, activation_function='tanh',
+                                      sparse=True)
+
+        assert sparse.issparse(esn_sparse.w), "w is not stored as sparse"
+        assert np.allclose(esn_dense.simulate(x, w_in),
+                           esn_sparse.simulate(x, w_in)), \
+            "sparse states differ from dense states"
+
+        # format is chosen again when w is reassigned
+        esn_sparse.w = 0.5 * w
+        assert sparse.issparse(esn_sparse.w), "w is not stored as sparse"
+
+        # small networks are kept dense in 'auto' mode
+        esn_auto = EchoStateNetwork(w=w, sparse='auto')
+        assert isinstance(esn_auto.w, np.ndarray)
+        esn_auto = EchoStateNetwork(w=np.zeros((1, 1)), sparse='auto')
+        assert isinstance(esn_auto.w, np.ndarray)
+
+    def test_simulate_drive(self, monkeypatch):
+        """
+        Test that a precomputed input drive and a block-wise projected
+        input drive yield the same states
+        """
+        w, w_in, x = create_test_reservoir()
+        esn = EchoStateNetwork(w=w, activation_function='tanh')
+
+        rs = esn.simulate(x, w_in)
+        drive = esn.input_drive(x, w_in)
+        assert drive.shape == (len(x), len(w))
+        assert np.allclose(rs, esn.simulate(drive=drive)), \
+            "states differ when the drive is precomputed"
+
+        # drive projected in blocks that do not divide the time series
+        monkeypatch.setattr(reservoir, 'DRIVE_BLOCK_SIZE', 37)
+        assert np.allclose(rs, esn.simulate(x, w_in)), \
+            "states differ when the drive is projected block-wise"
+
+        # precomputed drive of a list of trials
+        drive = esn.input_drive([x[:120], x[120:]], w_in)
+        rs_list = esn.simulate(drive=drive)
+        assert np.allclose(rs, np.vstack(rs_list))
+
+    def test_simulate_output_nodes(self):
+        """
+        Test that recording only the output nodes yields the same states
+        as recording all nodes
+        """
+        w, w_in, x = create_test_reservoir()
+        output_nodes = np.array([3, 7, 11])
+
+        esn = EchoStateNetwork(w=w, activation_function='tanh')
+        rs = esn.simulate(x, w_in, output_nodes=output_nodes)
+        assert esn._state.shape == (len(x), len(w))
+
+        rs_out = esn.simulate(x, w_in, output_nodes=output_nodes,
+                              save_state=False)
+        assert esn._state is None, "states of all nodes were stored"
+        assert np.allclose(rs, rs_out), \
+            "states differ when only output nodes are recorded"
+
+        rs_list = esn.simulate([x[:120], x[120:]], w_in,
+                               output_nodes=output_nodes, save_state=False)
+        assert np.allclose(rs, np.vstack(rs_list))
+
+    def test_simulate_washout(self):
+        """
+        Test that skipping the washout while simulating is equivalent to
+        removing it afterwards
+        """
+        w, w_in, x = create_test_reservoir()
+        esn = EchoStateNetwork(w=w, activation_function='tanh')
+
+        rs = esn.simulate(x, w_in)
+        rs_washout = esn.simulate(x, w_in, idx_washout=50)
+        assert np.allclose(esn.add_washout_time(rs, idx_washout=50)[0],
+                           rs_washout), "washout states differ"
+        assert esn._state.shape == (len(x) - 50, len(w))
+
+        # washout is applied to every trial
+        rs_list = esn.simulate([x[:120], x[120:]], w_in, idx_washout=50,
+                               output_nodes=[0, 1], save_state=False)
+        assert [len(rs) for rs in rs_list] == [70, 30]
+        assert np.allclose(rs_list[0], rs[50:120, :2])
+        assert np.allclose(rs_list[1], rs[170:, :2])
+
+    def test_simulate_independent_trials(self):
+        """
+        Test that independent trials simulated in lockstep match trials
+        simulated one at a time
+        """
+        w, w_in, x = create_test_reservoir()
+        trials = [x[:60], x[60:150], x[150:]]
+        ic = np.full(len(w), 0.1)
+        alphas = [0.5, 1.0]
+
+        for backend in ['numpy', 'numba']:
+            if backend == 'numba':
+                pytest.importorskip('numba')
+            esn = EchoStateNetwork(w=w, activation_function='tanh',
+                                   backend=backend)
+
+            rs_trials = esn.simulate(trials, w_in, ic=ic, alphas=alphas,
+                                     idx_washout=10, output_nodes=[2, 4],
+                                     independent_trials=True)
+            assert esn.last_state is None
+
+            for alpha, rs_alpha in zip(alphas, rs_trials):
+                esn.w = alpha * w
+                for trial, rs in zip(trials, rs_alpha):
+                    assert np.allclose(
+                        rs, esn.simulate(trial, w_in, ic=ic, idx_washout=10,
+                                         output_nodes=[2, 4])
+                    ), "independent trial states differ"
+            esn.w = w
+
+    def test_stream(self):
+        """
+        Test that streaming the input in chunks and resuming from the last
+        state is equivalent to a single continuous simulation
+        """
+        w, w_in, x = create_test_reservoir()
+        esn = EchoStateNetwork(w=w, activation_function='tanh')
+        rs = esn.simulate(x, w_in, idx_washout=30)
+
+        chunks = (x[i:i + 45] for i in range(0, len(x), 45))
+        rs_stream = list(esn.stream(chunks, w_in, idx_washout=30))
+        assert np.allclose(rs, np.vstack(rs_stream)), \
+            "streamed states differ from continuous states"
+        assert np.allclose(esn.last_state, rs[-1])
+
+        # train and test sets as one continuous run
+        rs_train = esn.simulate(x[:120], w_in)
+        rs_test = esn.simulate(x[120:], w_in, ic=esn.last_state)
+        assert np.allclose(np.vstack((rs_train, rs_test)),
+                           esn.simulate(x, w_in))
+
+    def test_simulate_float32(self):
+        """
+        Test that simulating in single precision does not change the memory
+        capacity obtained in double precision (relative deviation < 0.1%)
+        """
+        tasks = pytest.importorskip('conn2res.tasks')
+
+        w, _, _ = create_test_reservoir(n_nodes=100)
+        w_in = np.zeros((1, len(w)))
+        w_in[:, :10] = 1
+
+        task = tasks.Conn2ResTask(name='MemoryCapacity')
+        x, y = task.fetch_data(n_trials=2000, seed=0)
+        x_train, x_test, y_train, y_test = train_test_split(x, y)
+
+        for alpha in [0.5, 0.9, 1.1]:
+            scores = []
+            for dtype in [np.float64, np.float32]:
+                esn = EchoStateNetwork(w=alpha * w, dtype=dtype)
+                rs_train = esn.simulate(x_train, w_in)
+                rs_test = esn.simulate(x_test, w_in)
+                assert rs_train.dtype == dtype
+
+                readout_module = Readout(estimator=select_model(y))
+                df_res = readout_module.run_task(
+                    X=(rs_train, rs_test), y=(y_train, y_test),
+                    metric=['corrcoef'], multioutput='sum',
+                    nonnegative='absolute'
+                )
+                scores.append(df_res['corrcoef'][0])
+
+            assert np.isclose(scores[0], scores[1], rtol=1e-3, atol=0), \
+                f"float32 memory capacity deviates for alpha = {alpha}"
+
+    @pytest.mark.parametrize('activation', [
+        'linear', 'elu', 'relu', 'leaky_relu', 'sigmoid', 'tanh', 'step'
+    ])
+    def test_simulate_numba(self, activation):
+        """
+        Test that the compiled backend is equivalent to the numpy backend
+        for all built-in activation functions
+        """
+        pytest.importorskip('numba')
+
+        w, w_in, x = create_test_reservoir()
+        alphas = [0.5, 0.9]
+
+        for use_sparse in [False, True]:
+            esn_numpy = EchoStateNetwork(
+                w=w, activation_function=activation, sparse=use_sparse)
+            esn_numba = EchoStateNetwork(
+                w=w, activation_function=activation, sparse=use_sparse,
+                backend='numba')
+
+            assert np.allclose(esn_numpy.simulate(x, w_in, alphas=alphas),
+                               esn_numba.simulate(x, w_in, alphas=alphas)), \
+                f"numba states differ from numpy states for {activation}"
+            assert np.allclose(
+                esn_numpy.simulate(x, w_in, output_nodes=[1, 5],
+                                   idx_washout=20),
+                esn_numba.simulate(x, w_in, output_nodes=[1, 5],
+                                   idx_washout=20, save_state=False)
+            ), f"numba output nodes differ from numpy for {activation}"
+
+        # keyword arguments of the activation function
+        if activation == 'leaky_relu':
+            assert np.allclose(esn_numpy.simulate(x, w_in, alpha=0.1),
+                               esn_numba.simulate(x, w_in, alpha=0.1))
+
+
+    def test_activation_functions(self):
+        """
+        Test that activation functions write into 'out' and match their
+        definitions, and that user-supplied callables are supported
+        """
+        x = np.linspace(-2, 2, 41)
+        expected = {
+            'linear': 2 * x,
+            'elu': np.where(x > 0, x, 0.5 * (np.exp(x) - 1)),
+            'relu': np.maximum(0, x),
+            'leaky_relu': np.maximum(0.5 * x, x),
+            'sigmoid': 1 / (1 + np.exp(-x)),
+            'tanh': np.tanh(x),
+            'step': (x >= 0.5).astype(int),
+        }
+        w, w_in, ext_input = create_test_reservoir()
+        for name, y in expected.items():
+            esn = EchoStateNetwork(w=w, activation_function=name)
+            kwargs = {'m': 2} if name == 'linear' else {}
+
+            x_in = x.copy()
+            assert np.allclose(esn.activation_function(x_in, **kwargs), y)
+            assert np.array_equal(x_in, x), "input was modified"
+
+            out = np.empty_like(x)
+            res = esn.activation_function(x.copy(), out=out, **kwargs)
+            assert res is out and np.allclose(out, y)
+
+            # in place
+            out = x.copy()
+            res = esn.activation_function(out, out=out, **kwargs)
+            assert res is out and np.allclose(out, y), \
+                f"{name} is wrong when out is x"
+
+        # user-supplied callables with and without 'out'
+        def softsign(x, out=None):
+            out = np.abs(x, out=out)
+            out += 1
+            return np.divide(x, out, out=out)
+
+        def clip(x, vmax=1):
+            return np.clip(x, -vmax, vmax)
+
+        for func, ref in [(softsign, lambda u: u / (1 + np.abs(u))),
+                          (clip, lambda u: np.clip(u, -0.5, 0.5))]:
+            esn = EchoStateNetwork(w=w, activation_function=func)
+            kwargs = {'vmax': 0.5} if func is clip else {}
+            rs = esn.simulate(ext_input, w_in, **kwargs)
+
+            # states[-1] holds the zero initial conditions at t=0
+            states = np.zeros((len(ext_input), 50))
+            for t in range(len(ext_input)):
+                states[t] = ref(states[t-1] @ w + ext_input[t] @ w_in)
+            assert np.allclose(rs, states)
+
+        with pytest.raises(ValueError):
+            EchoStateNetwork(w=w, activation_function=clip, backend='numba')
+
+
+class TestEchoStateNetworkEnsemble():
+
+    def test_simulate(self):
+        """
+        Test that simulating an ensemble of networks matches simulating
+        each network separately
+        """
+        ws = np.stack([create_test_reservoir(seed=seed)[0]
+                       for seed in range(3)])
+        _, w_in, x = create_test_reservoir()
+        alphas = [0.5, 1.2]
+
+        ensemble = EchoStateNetworkEnsemble(w=ws, activation_function='tanh')
+        assert ensemble.n_networks == 3 and ensemble.n_nodes == 50
+
+        rs_ensemble = ensemble.simulate(x, w_in, alphas=alphas,
+                                        output_nodes=[0, 5],
+                                        save_state=False)
+        for w, rs in zip(ws, rs_ensemble):
+            esn = EchoStateNetwork(w=w, activation_function='tanh')
+            assert np.allclose(
+                rs, esn.simulate(x, w_in, alphas=alphas, output_nodes=[0, 5])
+            ), "ensemble states differ from single network states"
+
+        # list of trials without spectral scalings
+        rs_ensemble = list(ensemble.simulate([x[:120], x[120:]], w_in))
+        assert len(rs_ensemble) == 3
+        assert [len(rs) for rs in rs_ensemble[0]] == [120, 80]
+
+
+class TestLinearEchoStateNetwork():
+
+    @pytest.mark.parametrize('method', ['fft', 'eig'])
+    def test_simulate(self, method):
+        """
+        Test that the closed-form states match the time-stepped states of
+        an EchoStateNetwork with a linear activation function
+        """
+        w, w_in, x = create_test_reservoir()
+        ic = np.random.default_rng(1).normal(size=50)
+        alphas = [0.5, 0.9]
+
+        esn = EchoStateNetwork(w=w, activation_function='linear')
+        linear = LinearEchoStateNetwork(w=w, method=method)
+
+        kwargs = dict(ic=ic, alphas=alphas, m=0.8, idx_washout=10,
+                      output_nodes=[0, 5], save_state=False)
+        assert np.allclose(linear.simulate(x, w_in, **kwargs),
+                           esn.simulate(x, w_in, **kwargs))
+        assert np.allclose(linear.last_state, esn.last_state)
+
+        # precomputed drive and independent trials
+        trials = [x[:120], x[120:]]
+        rs_linear = linear.simulate(drive=linear.input_drive(trials, w_in),
+                                    independent_trials=True)
+        rs_esn = esn.simulate(trials, w_in, independent_trials=True)
+        for rs_l, rs_e in zip(rs_linear, rs_esn):
+            assert np.allclose(rs_l, rs_e)
+
+    def test_memory_capacity(self):
+        """
+        Test that the analytical memory capacity matches the squared
+        correlation of the optimal linear readout of simulated states
+        """
+        rng = np.random.default_rng(0)
+        w, _, _ = create_test_reservoir(n_nodes=20)
+        w_in = rng.normal(size=(1, 20))
+        linear = LinearEchoStateNetwork(w=w)
+
+        mc = linear.memory_capacity(w_in, horizon_max=-30, alphas=[0.9])
+        assert mc.shape == (1, 30)
+        assert np.all(mc <= 1 + 1e-8)
+        assert np.sum(mc) <= 20 + 1e-6
+
+        u = rng.uniform(-1, 1, size=(20000, 1))
+        rs = linear.simulate(u, w_in, alphas=0.9)[100:]
+        for lag in [1, 15, 30]:
+            y = u[100 - lag:-lag, 0]
+            coef = np.linalg.lstsq(rs, y, rcond=None)[0]
+            r2 = np.corrcoef(rs @ coef, y)[0, 1] ** 2
+            assert np.isclose(mc[0, lag - 1], r2, atol=0.02)
+
+
+class TestSpikingNeuralNetwork():
+
+    def test_simulate_float32(self):
+        """
+        Test that all recordings are kept in the requested precision
+        """
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=5)
+
+        snn = SpikingNeuralNetwork(w=w, dtype=np.float32)
+        rs = snn.simulate(x, w_in, timescale=20)
+
+        assert snn.w.dtype == np.float32
+        assert rs.shape == (len(x), len(w))
+        for rec in [rs, snn.REC, snn.Is, snn.IPSCs, snn.spk, snn.hs]:
+            assert rec.dtype == np.float32, "recording is not float32"
+
+    def test_spikes(self, tmp_path):
+        """
+        Test that the spike raster and its conversions are consistent
+        """
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=10)
+
+        snn = SpikingNeuralNetwork(w=w)
+        snn.simulate(x, 10 * w_in, timescale=50)
+
+        spikes = snn.spikes
+        indices, steps = spikes.indices, spikes.steps
+        assert indices.dtype == np.int32 and steps.dtype == np.int32
+        assert np.all(np.diff(steps) >= 0)
+        assert len(indices) == snn.spk.sum() > 0
+        assert np.all(snn.spk[indices, steps] == 1)
+        assert np.array_equal(snn.tspike[:, 0], indices)
+        assert np.allclose(snn.tspike[:, 1], steps * snn.dt)
+
+        # conversions, windows and round trip through disc
+        dense = spikes.to_dense()
+        assert dense.shape == (30, snn.nt)
+        assert np.array_equal(
+            np.unpackbits(spikes.to_packed(), axis=1, count=snn.nt), dense)
+        assert np.array_equal(spikes.counts(), dense.sum(1))
+        assert np.array_equal(spikes.counts(100, 201),
+                              dense[:, 100:201].sum(1))
+        assert np.array_equal(snn.all_fr * snn.T, dense[:, 10:].sum(1))
+
+        window = spikes.events(100, 201)
+        assert np.array_equal(dense[:, 100:201].nonzero()[0],
+                              np.sort(window[0]))
+
+        spikes.save(tmp_path / 'spikes.npz')
+        loaded = reservoir.SpikeRaster.load(tmp_path / 'spikes.npz')
+        assert np.array_equal(loaded.to_dense(), dense)
+        assert loaded.dt == spikes.dt
+
+    def test_simulate_record(self):
+        """
+        Test that only requested recordings are kept and decimated, without
+        changing the reservoir states
+        """
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=10)
+        snn = SpikingNeuralNetwork(w=w, inh=np.arange(30) < 6)
+
+        snn.rng = np.random.default_rng(0)
+        rs = snn.simulate(x, 10 * w_in, timescale=50)
+        full = {name: getattr(snn, name) for name in reservoir.SNN_RECORDINGS}
+        tspike = snn.tspike
+
+        snn.rng = np.random.default_rng(0)
+        rs_dec = snn.simulate(x, 10 * w_in, timescale=50,
+                              record={'REC': 3, 'IPSCs': 1})
+        assert np.array_equal(rs, rs_dec)
+        assert np.array_equal(tspike, snn.tspike)
+        assert snn.Is is None and snn.hs is None
+        assert np.array_equal(snn.REC, full['REC'][::3])
+        assert np.array_equal(snn.IPSCs, full['IPSCs'])
+
+        snn.rng = np.random.default_rng(0)
+        assert np.array_equal(
+            rs, snn.simulate(x, 10 * w_in, timescale=50, record=None))
+        assert all(getattr(snn, name) is None
+                   for name in reservoir.SNN_RECORDINGS)
+
+        with pytest.raises(ValueError):
+            snn.simulate(x, w_in, record={'REC': 0})
+
+    def test_simulate_sparse(self):
+        """
+        Test that event-driven propagation with sparse w matches the dense
+        simulation
+        """
+        rng = np.random.default_rng(0)
+        # weights are multiples of 1/8 such that sums are exact in any order
+        w = rng.integers(1, 8, size=(40, 40)) / 8
+        w[rng.random((40, 40)) > 0.2] = 0
+        w_in = rng.normal(size=(1, 40)) * 10
+        x = rng.uniform(-1, 1, size=(10, 1))
+        inh, som = np.arange(40) < 8, np.arange(40) < 3
+
+        dense = SpikingNeuralNetwork(w=w, inh=inh, som=som, seed=0)
+        sparse_snn = SpikingNeuralNetwork(w=w, inh=inh, som=som, sparse=True,
+                                          seed=0)
+        assert sparse.issparse(sparse_snn.w)
+        assert np.array_equal(sparse_snn.w.toarray(), dense.w)
+        assert np.all(dense.w[np.ix_(som, inh)] == 0)
+        assert np.all(dense.w[:, inh] <= 0) and np.all(dense.w[:, ~inh] >= 0)
+
+        rs_dense = dense.simulate(x, w_in, timescale=50)
+        rs_sparse = sparse_snn.simulate(x, w_in, timescale=50)
+        assert len(dense.tspike) > 0
+        assert np.array_equal(dense.tspike, sparse_snn.tspike)
+        assert np.allclose(rs_dense, rs_sparse)
+
+    def test_simulate_seed(self, monkeypatch):
+        """
+        Test that simulations are reproducible given a seed, independently
+        of the size of the noise blocks, and deterministic without noise
+        """
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=10)
+        kwargs = dict(timescale=50, stim_mode='exc', stim_dur=[0, 200],
+                      stim_units=np.arange(5), record=None)
+
+        snns = [SpikingNeuralNetwork(w=w, seed=seed) for seed in [0, 0, 1]]
+        rs = [snn.simulate(x, 10 * w_in, **kwargs) for snn in snns]
+        assert np.array_equal(rs[0], rs[1])
+        assert np.array_equal(snns[0].tspike, snns[1].tspike)
+        assert not np.array_equal(rs[0], rs[2])
+
+        # without a seed, the generator is seeded from the global state
+        rs_global = []
+        for _ in range(2):
+            np.random.seed(0)
+            snn = SpikingNeuralNetwork(w=w)
+            rs_global.append(snn.simulate(x, 10 * w_in, **kwargs))
+        assert np.array_equal(rs_global[0], rs_global[1])
+
+        # noise blocks of one time step draw the same random numbers
+        monkeypatch.setattr(reservoir, 'NOISE_BLOCK_SIZE', 30)
+        snn = SpikingNeuralNetwork(w=w, seed=0)
+        assert np.array_equal(rs[0], snn.simulate(x, 10 * w_in, **kwargs))
+
+        # without noise, only the initial voltages and stimulation are
+        # random
+        ic = np.linspace(-65, -45, 30)
+        rs = [SpikingNeuralNetwork(w=w, inh=np.arange(30) < 6,
+                                   seed=seed).simulate(
+                  x, 10 * w_in, ic=ic, noise=None, timescale=50)
+              for seed in [0, 1]]
+        assert np.array_equal(rs[0], rs[1])
+
+    @pytest.mark.parametrize('dtype', [np.float64, np.float32])
+    def test_simulate_numba(self, dtype):
+        """
+        Test that the compiled backend is statistically equivalent to the
+        numpy backend given the same seed
+        """
+        pytest.importorskip('numba')
+
+        w, w_in, x = create_test_reservoir(n_nodes=100, n_timesteps=20)
+        w_in = 10 * w_in
+        kwargs = dict(stim_mode='exc', stim_dur=[100, 1000],
+                      stim_units=np.arange(10), stim_val=2,
+                      record={'REC': 10, 'hs': 10})
+
+        for use_sparse in [False, True]:
+            snns = [SpikingNeuralNetwork(w=w, sparse=use_sparse, dtype=dtype,
+                                         seed=0, backend=backend)
+                    for backend in ['numpy', 'numba']]
+            rs = [snn.simulate(x, w_in, **kwargs) for snn in snns]
+
+            assert rs[1].dtype == dtype and snns[1].REC.dtype == dtype
+            assert snns[0].REC.shape == snns[1].REC.shape
+            # firing rates and filtered firing rates of the network
+            assert np.isclose(snns[0].all_fr.mean(), snns[1].all_fr.mean(),
+                              rtol=0.05)
+            assert np.isclose(rs[0].mean(), rs[1].mean(), rtol=0.05)
+            assert np.corrcoef(rs[0].mean(axis=1),
+                               rs[1].mean(axis=1))[0, 1] > 0.9
+
+    @pytest.mark.parametrize('backend', ['numpy', 'numba'])
+    def test_simulate_batch(self, backend):
+        """
+        Test that replicas simulated in a batch match separate simulations
+        """
+        if backend == 'numba':
+            pytest.importorskip('numba')
+
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=10)
+        w_in = 10 * w_in
+        ic = np.linspace(-65, -45, 30)
+        replicas = [dict(taus=taus, input_gain=input_gain, ic=ic)
+                    for taus in [20, 50] for input_gain in [0.5, 1]]
+        replicas[-1].update(sig_param=np.linspace(-1, 1, 30))
+
+        # without noise, replicas are deterministic given ic
+        snn = SpikingNeuralNetwork(w=w, seed=0, backend=backend)
+        rs = snn.simulate_batch(x, w_in, replicas, timescale=50, noise=None,
+                                record={'REC': 10})
+        assert rs.shape == (4, 10, 30)
+        assert snn.REC.shape == (4, 50, 30) and len(snn.spikes) == 4
+        for b, replica in enumerate(replicas):
+            snn_b = SpikingNeuralNetwork(w=w, seed=0, backend=backend)
+            assert np.array_equal(rs[b], snn_b.simulate(
+                x, w_in, timescale=50, noise=None, record={'REC': 10},
+                **replica))
+            assert np.array_equal(snn.REC[b], snn_b.REC)
+            assert np.array_equal(snn.tspike[b], snn_b.tspike)
+            assert np.array_equal(snn.all_fr[b], snn_b.all_fr)
+
+        # a batch of a single replica reproduces simulate given a seed
+        kwargs = dict(timescale=50, stim_mode='exc', stim_dur=[0, 200],
+                      stim_units=np.arange(5), sig_param='normal')
+        snns = [SpikingNeuralNetwork(w=w, seed=0, backend=backend)
+                for _ in range(2)]
+        assert np.array_equal(
+            snns[0].simulate(x, w_in, output_nodes=[1, 2], **kwargs),
+            snns[1].simulate_batch([x], w_in, output_nodes=[1, 2],
+                                   **kwargs)[0])
+
+        # replicas of different lengths are trimmed to their own time steps
+        inputs = [x, x[:5], x[:7]]
+        rs = snn.simulate_batch(inputs, w_in, [dict(ic=ic)] * 3, timescale=50,
+                                noise=None, record={'REC': 10, 'hs': 7})
+        assert [len(r) for r in rs] == [10, 5, 7]
+        assert np.array_equal(snn.nt, [500, 250, 350])
+        rates = snn.firing_rates(window=2)
+        for b, x_b in enumerate(inputs):
+            snn_b = SpikingNeuralNetwork(w=w, seed=0, backend=backend)
+            assert np.array_equal(rs[b], snn_b.simulate(
+                x_b, w_in, ic=ic, timescale=50, noise=None,
+                record={'REC': 10, 'hs': 7}))
+            assert np.array_equal(snn.REC[b], snn_b.REC)
+            assert np.array_equal(snn.hs[b], snn_b.hs)
+            assert np.array_equal(snn.spike_counts[b], snn_b.spike_counts)
+            assert np.array_equal(snn.tspike[b], snn_b.tspike)
+            assert np.array_equal(snn.spk[b], snn_b.spk)
+            assert np.array_equal(snn.all_fr[b], snn_b.all_fr)
+            assert np.array_equal(rates[b], snn_b.firing_rates(window=2))
+
+    def test_stimulation(self):
+        """
+        Test stimulation protocols and their compatibility with stim_mode
+        """
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=10)
+        kwargs = dict(timescale=50, record=None)
+
+        with pytest.raises(ValueError):
+            reservoir.Stimulation([0, 1], onset=10, offset=5)
+        with pytest.raises(ValueError):
+            reservoir.Stimulation([0, 1], 0, 10, probability=2)
+        with pytest.raises(ValueError):
+            reservoir.Stimulation.from_stim_mode('exc', [0, 10], None)
+        with pytest.raises(ValueError):
+            SpikingNeuralNetwork(w=w).simulate(
+                x, w_in, stim=reservoir.Stimulation([30], 0, 10), **kwargs)
+
+        # stim_mode is a single protocol
+        stim = reservoir.Stimulation(np.arange(5), 0, 200, amplitude=-1)
+        rs = [SpikingNeuralNetwork(w=w, seed=0).simulate(
+                  x, 10 * w_in, **kwargs, **stim_kwargs)
+              for stim_kwargs in [
+                  dict(stim_mode='inh', stim_dur=[0, 200],
+                       stim_units=np.arange(5), stim_val=1),
+                  dict(stim=stim)]]
+        assert np.array_equal(rs[0], rs[1])
+
+        # concurrent protocols add up; protocols that are never applied
+        # leave the simulation unchanged
+        stims = [reservoir.Stimulation(np.arange(5), 0, 500, amplitude=a,
+                                       probability=1) for a in [2, -2]]
+        rs = [SpikingNeuralNetwork(w=w, seed=0).simulate(
+                  x, 10 * w_in, stim=stim, **kwargs)
+              for stim in [None, stims, stims[:1],
+                           reservoir.Stimulation([1], 0, 500, 5, 0)]]
+        assert np.array_equal(rs[0], rs[1])
+        assert np.array_equal(rs[0], rs[3])
+        assert rs[2][:, :5].sum() > rs[0][:, :5].sum()
+
+    def test_simulate_numba_stimulation(self):
+        """
+        Test that the compiled backend applies concurrent stimulation
+        protocols like the numpy backend
+        """
+        pytest.importorskip('numba')
+
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=10)
+        stim = [reservoir.Stimulation(np.arange(5), 100, 300, amplitude=2),
+                reservoir.Stimulation([3, 8, 9], 200, 400, amplitude=-1,
+                                      probability=0.8)]
+        snns = [SpikingNeuralNetwork(w=w, seed=0, backend=backend)
+                for backend in ['numpy', 'numba']]
+        rs = [snn.simulate(x, 10 * w_in, timescale=50, stim=stim,
+                           stim_mode='exc', stim_dur=[0, 100],
+                           stim_units=[0, 1], record=None)
+              for snn in snns]
+        assert np.allclose(rs[0], rs[1])
+
+    def test_refractory_period(self):
+        """
+        Test that neurons do not spike during their refractory period and
+        that the state of the neurons is reused across simulations
+        """
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=10)
+        snn = SpikingNeuralNetwork(w=w, seed=0)
+        snn.rng = np.random.default_rng(1)
+        rs = snn.simulate(x, 10 * w_in, timescale=50, tref=1, record=None)
+
+        # 1 ms refractory period (20 time steps of 0.05 ms)
+        indices, steps = snn.spikes.indices, snn.spikes.steps
+        assert len(indices) > 0
+        for node in range(30):
+            assert np.all(np.diff(steps[indices == node]) > 20)
+
+        lif = snn._lif
+        snn.rng = np.random.default_rng(1)
+        assert np.array_equal(rs, snn.simulate(x, 10 * w_in, timescale=50,
+                                               tref=1, record=None))
+        assert snn._lif is lif
+
+    def test_firing_rates(self):
+        """
+        Test that the spike counts accumulated while simulating match the
+        spike raster and the windowed firing rates derived from them
+        """
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=10)
+        snn = SpikingNeuralNetwork(w=w, seed=0)
+        snn.simulate([x[:4], x[4:]], 10 * w_in, timescale=50, record=None)
+
+        spk = snn.spk.reshape(30, 10, 50).sum(axis=-1).T
+        assert np.array_equal(snn.spike_counts, spk)
+        assert np.allclose(snn.inh_fr, spk.sum(axis=0)[snn.inh] / snn.T)
+        assert np.allclose(snn.exc_fr, spk.sum(axis=0)[snn.exc] / snn.T)
+
+        # firing rates over the whole simulation, every external time step,
+        # windows and trials
+        duration = 50 * snn.dt
+        assert np.allclose(snn.firing_rates(), spk.sum(axis=0) / snn.T)
+        assert np.allclose(snn.firing_rates(1), spk / duration)
+        assert np.allclose(
+            snn.firing_rates(4),
+            [spk[:4].sum(axis=0) / (4 * duration),
+             spk[4:8].sum(axis=0) / (4 * duration),
+             spk[8:].sum(axis=0) / (2 * duration)])
+        assert np.allclose(snn.firing_rates('trial'),
+                           snn.firing_rates([0, 4, 10]))
+        assert np.allclose(snn.firing_rates([2, 5]),
+                           spk[2:5].sum(axis=0) / (3 * duration))
+        with pytest.raises(ValueError):
+            snn.firing_rates([5, 2])
+
+        snn.simulate(x, 10 * w_in, timescale=50, record=None)
+        with pytest.raises(ValueError):
+            snn.firing_rates('trial')
+
+    def test_checkpoint(self, tmp_path, monkeypatch):
+        """
+        Test that simulating in chunks does not change the results and that
+        an interrupted simulation resumes from its checkpoint
+        """
+        w, w_in, x = create_test_reservoir(n_nodes=30, n_timesteps=10)
+        record = {'REC': 3, 'hs': 7}
+
+        snn = SpikingNeuralNetwork(w=w, seed=0)
+        rs = snn.simulate(x, 10 * w_in, timescale=50, record=record)
+        expected = snn.REC, snn.hs, snn.spike_counts, snn.tspike
+
+        def check(snn, states):
+            assert np.array_equal(states, rs)
+            for actual, desired in zip((snn.REC, snn.hs, snn.spike_counts,
+                                        snn.tspike), expected):
+                assert np.array_equal(actual, desired)
+
+        snn = SpikingNeuralNetwork(w=w, seed=0)
+        check(snn, snn.simulate(x, 10 * w_in, timescale=50, record=record,
+                                chunk_size=3))
+
+        # interrupt the simulation while saving the state of the third
+        # segment
+        save = reservoir.LIFState.save
+        calls = []
+
+        def interrupted(self, fname):
+            calls.append(fname)
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            save(self, fname)
+
+        monkeypatch.setattr(reservoir.LIFState, 'save', interrupted)
+        snn = SpikingNeuralNetwork(w=w, seed=0)
+        with pytest.raises(KeyboardInterrupt):
+            snn.simulate(x, 10 * w_in, timescale=50, record=record,
+                         chunk_size=3, checkpoint=tmp_path)
+        monkeypatch.undo()
+
+        state = reservoir.LIFState.load(tmp_path / 'state.npz')
+        assert state.step == 2 * 3 * 50
+        snn = SpikingNeuralNetwork(w=w, seed=0)
+        check(snn, snn.simulate(x, 10 * w_in, timescale=50, record=record,
+                                chunk_size=3, checkpoint=tmp_path))
+        assert snn.state.step == snn.nt
+
+        # checkpoints of other simulations are not resumed
+        with pytest.raises(ValueError):
+            snn.simulate(x, 10 * w_in, timescale=50, record=record,
+                         chunk_size=4, checkpoint=tmp_path)
+        with pytest.raises(ValueError):
+            snn.simulate(x[::-1], 10 * w_in, timescale=50, record=record,
+                         chunk_size=3, checkpoint=tmp_path)
+        with pytest.raises(ValueError):
+            snn.simulate(x, 5 * w_in, timescale=50, record=record,
+                         chunk_size=3, checkpoint=tmp_path)
+        with pytest.raises(ValueError):
+            snn.simulate(x, 10 * w_in, timescale=50, record=record,
+                         chunk_size=3, checkpoint=tmp_path, taus=5)
+        with pytest.raises(ValueError):
+            snn.simulate(x, 10 * w_in, timescale=50, record=record,
+                         chunk_size=3, checkpoint=tmp_path,
+                         ic=np.full(30, -50))
+
+        # decay time constants drawn from the generator are restored
+        snn = SpikingNeuralNetwork(w=w, seed=1)
+        rs = snn.simulate(x, 10 * w_in, timescale=50, record=None,
+                          sig_param='normal', chunk_size=3,
+                          checkpoint=tmp_path / 'normal')
+        td = snn.td
+        assert np.array_equal(
+            snn.simulate(x, 10 * w_in, timescale=50, record=None,
+                         sig_param='normal', chunk_size=3,
+                         checkpoint=tmp_path / 'normal'), rs)
+        assert np.array_equal(snn.td, td)
+
+        # random number generators with any bit generator
+        snn = SpikingNeuralNetwork(
+            w=w, seed=np.random.Generator(np.random.MT19937(0)))
+        rs = snn.simulate(x, 10 * w_in, timescale=50, record=None)
+        snn = SpikingNeuralNetwork(
+            w=w, seed=np.random.Generator(np.random.MT19937(0)))
+        assert np.array_equal(
+            snn.simulate(x, 10 * w_in, timescale=50, record=None,
+                         chunk_size=3, checkpoint=tmp_path / 'mt19937'), rs)
+        rng_state = snn.rng.bit_generator.state
+        assert np.array_equal(
+            snn.simulate(x, 10 * w_in, timescale=50, record=None,
+                         chunk_size=3, checkpoint=tmp_path / 'mt19937'), rs)
+        assert np.array_equal(snn.rng.bit_generator.state['state']['key'],
+                              rng_state['state']['key'])
+
+
+class TestMemristiveReservoir():
+
+    def test_solveVi(self):
+        """
+        Test that the internal voltages solve Kirchhoff's law, as with the
+        pseudo-inverse of the Laplacian block of the internal nodes, for
+        dense and sparse conductances and for singular blocks
+        """
+        int_nodes, ext_nodes, gr_nodes = np.arange(54), [54, 55, 56], \
+            [57, 58, 59]
+        ve = np.random.default_rng(0).uniform(size=3)
+
+        # connected, an isolated internal node and an internal 2-node island
+        for case in ('connected', 'isolated', 'island'):
+            w, _, _ = create_test_reservoir(n_nodes=60)
+            if case == 'isolated':
+                w[0] = w[:, 0] = 0
+            elif case == 'island':
+                w[:2] = w[:, :2] = 0
+                w[0, 1] = w[1, 0] = 1
+            mr = MemristiveReservoir(w, int_nodes, ext_nodes, gr_nodes)
+            # with this seed, the Cholesky factorization of the block with
+            # the island succeeds with a pivot rounded to a tiny value
+            G = mr.init_property(1.0, seed=2)
+
+            A = np.diag(G.sum(axis=1)) - G
+            A_II = A[np.ix_(int_nodes, int_nodes)]
+            expected = np.linalg.pinv(A_II) @ (
+                G[np.ix_(int_nodes, ext_nodes)] @ ve)
+
+            assert np.allclose(mr.solveVi(ve, G=G), expected)
+            assert np.allclose(mr.solveVi(ve, G=sparse.csr_matrix(G)),
+                               expected)
+
+            # minimum norm least squares solution of singular blocks given
+            # any right-hand side
+            b = np.random.default_rng(1).uniform(size=len(int_nodes))
+            expected = np.linalg.pinv(A_II) @ b
+            assert np.allclose(reservoir._solve_laplacian(A_II, b), expected)
+            assert np.allclose(
+                reservoir._solve_laplacian(sparse.csr_matrix(A_II), b),
+                expected)
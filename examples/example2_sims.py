@@ -81,27 +81,36 @@ def run_workflow(filename=None):
 
     x_train, x_test, y_train, y_test = readout.train_test_split(x, y)
 
-    active_rsn_modules = RSN_MAPPING[conn.idx_node == 1]
+    # input drive is shared by all values of alpha
+    drive_train = esn.input_drive(x_train, w_in)
+    drive_test = esn.input_drive(x_test, w_in)
 
-    df_alpha = []
-    for alpha in ALPHAS:
+    active_rsn_modules = RSN_MAPPING[conn.idx_node == 1]
 
-        print(f'\n\t\t\t----- alpha = {alpha} -----')
+    # all values of alpha are simulated at once, i.e., one simulation per
+    # split returns the reservoir states of every alpha
+    rs_train = esn.simulate(
+        drive=drive_train,
+        alphas=ALPHAS,
+        output_nodes=output_nodes,
+        save_state=False
+    )
 
-        esn.w = alpha * conn.w
+    rs_test = esn.simulate(
+        drive=drive_test,
+        alphas=ALPHAS,
+        output_nodes=output_nodes,
+        save_state=False
+    )
 
-        rs_train = esn.simulate(
-            ext_input=x_train, w_in=w_in,
-            output_nodes=output_nodes
-        )
+    df_alpha = []
+    for alpha, rs_train_alpha, rs_test_alpha in zip(ALPHAS, rs_train,
+                                                    rs_test):
 
-        rs_test = esn.simulate(
-            ext_input=x_test, w_in=w_in,
-            output_nodes=output_nodes
-        )
+        print(f'\n\t\t\t----- alpha = {alpha} -----')
 
         df_res = readout_module.run_task(
-            X=(rs_train, rs_test), y=(y_train, y_test),
+            X=(rs_train_alpha, rs_test_alpha), y=(y_train, y_test),
             sample_weight='both', metric=METRIC,
             readout_modules=active_rsn_modules[output_nodes], readout_nodes=None,
         )